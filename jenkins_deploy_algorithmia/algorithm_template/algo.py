@@ -1,32 +1,94 @@
 import Algorithmia
 from sklearn.externals import joblib
 from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+import io
 import numpy as np
+import requests
 
 client = Algorithmia.client()
 
+fetch_workers = 8 # concurrent image downloads for a list of image URLs
+fetch_timeout = 10 # seconds to connect to and read from an image host
+max_image_bytes = 10 * 1024 * 1024 # larger downloads are rejected
+max_image_pixels = 50 * 1000 * 1000 # larger images are rejected before they are decoded
+
+# one pooled session, so connections to image hosts are reused across requests
+session = requests.Session()
+session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=fetch_workers, pool_maxsize=fetch_workers))
+session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=fetch_workers, pool_maxsize=fetch_workers))
+fetch_executor = ThreadPoolExecutor(max_workers=fetch_workers)
+
 # load model from Data URI - see https://algorithmia.com/developers/data/
 modelFile = client.file('data://username/demo/digits_classifier.pkl').getFile().name
 model = joblib.load(modelFile)
 
-def apply(imgPath):
-    # (optional) use SmartDownloader to download image safely - see https://algorithmia.com/algorithms/util/SmartImageDownloader
-    imgPath = client.algo('util/SmartImageDownloader/0.2.18').pipe(imgPath).result['savePath'][0]
-    imgFile = client.file(imgPath).getFile().name
-    img = Image.open(imgFile)
-    # resize and greyscale image
-    img = img.resize((8, 8), Image.BICUBIC)
-    img = greyscale(img)
+def apply(input):
+    # a list of image URLs is classified with a single predict call
+    if isinstance(input, list):
+        # download concurrently, at most fetch_workers at a time
+        imgs = list(fetch_executor.map(load_image, input))
+        return [int(label) for label in model.predict(preprocess(imgs))]
     # predict using pre-loaded classifier
-    return int(model.predict([img.flatten()])[0])
+    return int(model.predict(preprocess([load_image(input)]))[0])
+
+def load_image(imgPath):
+    # images are decoded straight from memory, nothing is written to disk
+    if imgPath.startswith('http://') or imgPath.startswith('https://'):
+        data = download(imgPath)
+    else:
+        # Data URIs, e.g. data://username/demo/digit.png - see https://algorithmia.com/developers/data/
+        data = client.file(imgPath).getBytes()
+        if len(data) > max_image_bytes:
+            raise Exception("Image {} is larger than {} bytes".format(imgPath, max_image_bytes))
+    img = Image.open(io.BytesIO(data))
+    if img.size[0] * img.size[1] > max_image_pixels:
+        raise Exception("Image {} has more than {} pixels".format(imgPath, max_image_pixels))
+    img.load()
+    return img
+
+def download(url):
+    with session.get(url, stream=True, timeout=fetch_timeout) as response:
+        response.raise_for_status()
+        content_type = response.headers.get('Content-Type', '')
+        if not content_type.startswith('image/'):
+            raise Exception("{} is not an image ({})".format(url, content_type or 'no content type'))
+        if int(response.headers.get('Content-Length') or 0) > max_image_bytes:
+            raise Exception("Image {} is larger than {} bytes".format(url, max_image_bytes))
+        # the Content-Length may be missing or wrong, so the limit is also checked while reading
+        data = bytearray()
+        for chunk in response.iter_content(64 * 1024):
+            data.extend(chunk)
+            if len(data) > max_image_bytes:
+                raise Exception("Image {} is larger than {} bytes".format(url, max_image_bytes))
+        return bytes(data)
+
+def preprocess(imgs):
+    # resize and greyscale images into one row of 64 features per image
+    pixels = [np.array(img.resize((8, 8), Image.BICUBIC)) for img in imgs]
+    features = np.empty((len(pixels), 64))
+    # images with the same mode (number of channels) are greyscaled as one stack
+    groups = {}
+    for index, img in enumerate(pixels):
+        groups.setdefault(img.shape, []).append(index)
+    for indices in groups.values():
+        stack = np.stack([pixels[index] for index in indices])
+        features[indices] = greyscale_stack(stack).reshape(len(indices), -1)
+    return features
 
 def greyscale(img):
-    img = np.array(img)
-    greyscale = np.zeros((img.shape[0], img.shape[1]))
-    for rownum in range(len(img)):
-        for colnum in range(len(img[rownum])):
-            greyscale[rownum][colnum] = 255.0 - np.average(img[rownum][colnum])
-    amin = np.amin(greyscale)
+    return greyscale_stack(np.array(img)[np.newaxis])[0]
+
+def greyscale_stack(imgs):
+    # imgs is (images, rows, columns) or (images, rows, columns, channels)
+    imgs = np.asarray(imgs)
+    if imgs.ndim == 4:
+        # average the channels of every pixel, like np.average per pixel
+        greyscale = 255.0 - imgs.mean(axis=3)
+    else:
+        greyscale = 255.0 - imgs.astype(np.float64)
+    amin = np.amin(greyscale, axis=(1, 2), keepdims=True)
     greyscale = np.subtract(greyscale, amin)
-    P = 1/(np.amax(greyscale) - amin)
-    return P * np.array(greyscale)
\ No newline at end of file
+    # the scale is taken after subtracting the minimum, as in the per-pixel version
+    P = 1/(np.amax(greyscale, axis=(1, 2), keepdims=True) - amin)
+    return P * greyscale
@@ -1,5 +1,7 @@
 import Algorithmia
 import argparse
+import os
+import shutil
 from retry import retry
 from Algorithmia.errors import AlgorithmException
 
@@ -119,9 +121,13 @@ def deploy(args):
     
     shutil.copyfile(args.model_dependency_file, dependency_file_path)
 
+    # The micro-batching helper the script imports lives next to it
+    batching_script = os.path.join(os.path.dirname(args.model_script), "micro_batching.py")
+    shutil.copyfile(batching_script, "{}/{}/src/micro_batching.py".format(local_dir, args.algoname))
+
     ### 7. Upload our source code ###
     
-    files = ["src/{}.py".format(args.algoname), "requirements.txt"]
+    files = ["src/{}.py".format(args.algoname), "src/micro_batching.py", "requirements.txt"]
     cloned_repo.index.add(files)
 
     cloned_repo.index.commit("Add algorithm files")
@@ -0,0 +1,118 @@
+import threading
+import time
+import queue
+from collections import deque
+from concurrent.futures import Future
+import numpy as np
+
+class MicroBatcher:
+    '''
+    Coalesces concurrent predict calls into batches. Callers queue their inputs and wait,
+    a single worker thread collects queued inputs until it has max_batch_size rows or the
+    oldest one has waited max_wait seconds, runs one forward pass per input shape and hands
+    every caller its own rows of the result. If a forward pass fails, its inputs are retried
+    one at a time, so an error only reaches the caller whose input caused it.
+    '''
+    def __init__(self, predict, max_batch_size=32, max_wait=0.005, max_queue_size=1024, stats_window=1000):
+        self.predict_batch = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "rows": 0, "batches": 0, "errors": 0, "retries": 0}
+        # Recent batch sizes and queue waits, for percentiles
+        self.batch_sizes = deque(maxlen=stats_window)
+        self.queue_waits = deque(maxlen=stats_window)
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+                self._thread.start()
+
+    def predict(self, inputs):
+        '''
+        Predict a (rows, ...) array of inputs, blocks until its batch has run
+        '''
+        inputs = np.asarray(inputs)
+        if inputs.ndim == 0:
+            raise ValueError("inputs must be an array of rows, got a scalar")
+        if self._thread is None:
+            self.start()
+        future = Future()
+        self._queue.put((inputs, future, time.monotonic()))
+        return future.result()
+
+    def _collect(self):
+        '''
+        Wait for the first request, then take more until the batch is full or max_wait has passed
+        '''
+        requests = [self._queue.get()]
+        rows = len(requests[0][0])
+        deadline = requests[0][2] + self.max_wait
+        while rows < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                request = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            requests.append(request)
+            rows += len(request[0])
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self._collect()
+            started = time.monotonic()
+            sizes = [len(inputs) for inputs, _, _ in requests]
+            with self._lock:
+                self.stats["requests"] += len(requests)
+                self.stats["rows"] += sum(sizes)
+                self.stats["batches"] += 1
+                self.batch_sizes.append(sum(sizes))
+                self.queue_waits.extend(started - queued for _, _, queued in requests)
+            # Rows of different shapes can't be stacked, every shape gets its own forward pass
+            groups = {}
+            for request in requests:
+                groups.setdefault(request[0].shape[1:], []).append(request)
+            for group in groups.values():
+                self._predict(group)
+
+    def _predict(self, requests):
+        try:
+            outputs = self.predict_batch(np.concatenate([inputs for inputs, _, _ in requests]))
+        except Exception as err:
+            if len(requests) > 1:
+                with self._lock:
+                    self.stats["retries"] += len(requests)
+                for request in requests:
+                    self._predict([request])
+                return
+            with self._lock:
+                self.stats["errors"] += 1
+            requests[0][1].set_exception(err)
+            return
+        offset = 0
+        for inputs, future, _ in requests:
+            future.set_result(outputs[offset:offset + len(inputs)])
+            offset += len(inputs)
+
+    def get_stats(self):
+        '''
+        Counters plus the mean and percentiles of recent batch sizes and queue waits (in seconds)
+        '''
+        with self._lock:
+            stats = dict(self.stats)
+            batch_sizes = sorted(self.batch_sizes)
+            queue_waits = sorted(self.queue_waits)
+        stats["queued"] = self._queue.qsize()
+        for name, values in (("batch_size", batch_sizes), ("queue_wait", queue_waits)):
+            if not values:
+                continue
+            stats[name + "_mean"] = sum(values) / len(values)
+            for q in (0.5, 0.95, 0.99):
+                stats["{}_p{}".format(name, int(q * 100))] = values[min(int(q * len(values)), len(values) - 1)]
+            stats[name + "_max"] = values[-1]
+        return stats
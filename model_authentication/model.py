@@ -2,18 +2,68 @@ import Algorithmia
 from tensorflow import keras
 import numpy as np
 import hashlib
+import json
+import os
+import tempfile
+from micro_batching import MicroBatcher
 
-def sha256_checksum(filename, block_size=65536):
-    # Let's read in 64KB chunks
+# Verified model files are kept here, named after their checksum
+model_cache_dir = os.path.join(tempfile.gettempdir(), "model_cache")
+
+def cached_model_file(data_file, checksum, block_size=65536):
+    # Returns a local copy of data_file that has been verified against checksum.
+    # A file verified earlier is used as long as its size and mtime still match its manifest,
+    # otherwise the file is downloaded and hashed in the same pass.
+    model_file = os.path.join(model_cache_dir, "sha256-{}".format(checksum))
+    manifest_file = model_file + ".json"
+    if is_verified(model_file, manifest_file, checksum):
+        print("Using verified model file {}".format(model_file))
+        return model_file
+    os.makedirs(model_cache_dir, exist_ok=True)
     sha256 = hashlib.sha256()
-    with open(filename, "rb") as f:
-        for block in iter(lambda: f.read(block_size), b""):
-            sha256.update(block)
-    return sha256.hexdigest()
+    # Download next to the cache entry, so the file only gets its final name once verified
+    with tempfile.NamedTemporaryFile(dir=model_cache_dir, delete=False) as f:
+        try:
+            for block in stream_data_file(data_file, block_size):
+                sha256.update(block)
+                f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+        except Exception:
+            os.remove(f.name)
+            raise
+    print("Asserting {}=={}".format(sha256.hexdigest(), checksum))
+    if sha256.hexdigest() != checksum:
+        os.remove(f.name)
+        raise AssertionError("Checksum of {} is {}, expected {}".format(data_file.path, sha256.hexdigest(), checksum))
+    os.replace(f.name, model_file)
+    write_manifest(model_file, manifest_file, checksum, data_file.path)
+    return model_file
+
+def stream_data_file(data_file, block_size):
+    # Like DataFile.getFile(), without buffering the whole file in memory or on disk first
+    with client.getStreamHelper(data_file.url) as response:
+        response.raise_for_status()
+        for block in response.iter_content(block_size):
+            if block:
+                yield block
+
+def is_verified(model_file, manifest_file, checksum):
+    try:
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        stat = os.stat(model_file)
+    except (OSError, ValueError):
+        return False
+    return (manifest.get("sha256") == checksum and manifest.get("size") == stat.st_size and
+            manifest.get("mtime_ns") == stat.st_mtime_ns)
 
-def authenticate_model(model_file, checksum):
-    print("Asserting {}=={}".format(sha256_checksum(model_file), checksum))
-    assert(sha256_checksum(model_file)==checksum)
+def write_manifest(model_file, manifest_file, checksum, source):
+    stat = os.stat(model_file)
+    manifest = {"sha256": checksum, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "source": source}
+    with tempfile.NamedTemporaryFile("w", dir=model_cache_dir, delete=False) as f:
+        json.dump(manifest, f)
+    os.replace(f.name, manifest_file)
 
 # Create our Algorithmia client
 client = Algorithmia.client()
@@ -24,19 +74,20 @@ model_file_checksum = "<MODEL_FILE_CHECKSUM>"
 # Define where our model file lives in our data collection
 data_model = "data://<DATA_DIR>/model.h5"
 
-# Download & initialize our model
-model_file = client.file(data_model).getFile().name
-
-# Authenticate model file before doing anything
-authenticate_model(model_file, model_file_checksum)
+# Download & authenticate our model file before doing anything, or reuse the verified copy from an earlier start
+model_file = cached_model_file(client.file(data_model), model_file_checksum)
 
 model = keras.models.load_model(model_file)
 
+# Concurrent requests are predicted together, up to max_batch_size images or max_batch_wait seconds
+max_batch_size = 32
+max_batch_wait = 0.005
+batcher = MicroBatcher(model.predict, max_batch_size, max_batch_wait)
+
 def preprocess_input(two_d_array):
-    # Check if the dimensions are 28 x 28
-    assert(len(two_d_array[0])==28)
-    assert(len(two_d_array[1])==28)
     np_array = np.array(two_d_array)
+    # Check if the dimensions are 28 x 28, before the input is batched with other requests
+    assert(np_array.shape==(28, 28))
     # Expand dimension by 1 for model consumption
     np_array = (np.expand_dims(np_array,0))
     return np_array
@@ -44,8 +95,8 @@ def preprocess_input(two_d_array):
 def apply(input):
     # Get input text
     input_vector = preprocess_input(input)
-    # Get probability using our model
-    preds = model.predict(input_vector)
+    # Get probability using our model, batched with concurrent requests
+    preds = batcher.predict(input_vector)
     probs = list(map(lambda x: float(x), preds[0]))
     # Return result back to user
     return {"prob": probs}
\ No newline at end of file
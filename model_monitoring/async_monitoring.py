@@ -0,0 +1,399 @@
+import asyncio
+import base64
+import contextvars
+import json
+import random
+import time
+import aiohttp
+import aiomysql
+from Algorithmia.errors import AlgorithmException
+import model_monitoring as mm
+
+api_address = "https://api.algorithmia.com"
+api_key = "simXXXXXXXX"
+max_in_flight = 2000 # Requests handled at the same time by one process, the rest wait for a slot
+http_connections = 200 # Maximum number of open connections to the Algorithmia API
+
+class AsyncMonitor:
+    '''
+    asyncio version of model_monitoring.call_algorithm().
+    Reads go through an aiomysql pool (or straight to a local mm.store) and downstream calls through an aiohttp session, so
+    a single process can keep thousands of requests in flight. Routing, the per algorithm state,
+    sample writing and the experiment resolver are shared with the sync path. The rare writes
+    (first stable version, experiment start) run the sync code on a thread. Every call targets
+    the algorithm set with mm.targeting(), which asyncio tasks inherit.
+    db_pool and session only need acquire() and post(), so local stand-ins work too; with
+    db_pool=None settings are read from mm.store.
+    '''
+    def __init__(self, db_pool, session, api_address=api_address, api_key=api_key, max_in_flight=max_in_flight):
+        self.db_pool = db_pool
+        self.session = session
+        self.api_address = api_address
+        self.api_key = api_key
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._setup_lock = asyncio.Lock()
+        self._shadow_slots = asyncio.Semaphore(mm.shadow_workers)
+        self._background_tasks = set()
+
+    @classmethod
+    async def create(cls):
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=http_connections))
+        if not isinstance(mm.store, mm.MySQLStore):
+            # SQLite and in-memory stores are local, they are read directly
+            return cls(None, session)
+        db_pool = await aiomysql.create_pool(host=mm.db_host, user=mm.db_username, password=mm.db_password,
+                                             db=mm.db_name, autocommit=True, maxsize=mm.db_pool_size)
+        return cls(db_pool, session)
+
+    async def close(self):
+        await self.session.close()
+        if self.db_pool is not None:
+            self.db_pool.close()
+            await self.db_pool.wait_closed()
+
+    async def run_sync(self, func, *args):
+        # Run in this task's context, so func targets the same algorithm
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(None, context.run, func, *args)
+
+    async def query(self, statement, params=None):
+        async with self.db_pool.acquire() as cnx:
+            async with cnx.cursor() as cursor:
+                await cursor.execute(statement, params)
+                return await cursor.fetchall()
+
+    async def cached(self, key, loader):
+        '''
+        Read a setting through the settings cache of the target algorithm, loading a miss with a coroutine
+        '''
+        settings_cache = mm.current_state().settings_cache
+        hit, value, generation = settings_cache.lookup(key)
+        if hit:
+            return value
+        value = await loader()
+        settings_cache.store(key, value, generation)
+        return value
+
+    async def get_db_setting(self, setting):
+        algorithm = mm.current_state().name
+        if self.db_pool is None:
+            return mm.store.get_setting(algorithm, setting)
+        rows = await self.query("SELECT val FROM {}.metaData WHERE algo_name = %s AND setting = %s".format(mm.db_name),
+                                (algorithm, setting))
+        # A missing setting reads as None, like mm.store.get_setting()
+        return rows[0][0] if rows else None
+
+    async def get_db_version(self, setting):
+        return mm.to_semantic_version(await self.get_db_setting(setting))
+
+    async def get_db_stable_version(self):
+        return await self.cached('stable_version', lambda: self.get_db_version('stable_version'))
+
+    async def get_db_exp_version(self):
+        return await self.cached('experiment_version', lambda: self.get_db_version('experiment_version'))
+
+    async def is_experiment_running(self):
+        exp_running = await self.cached('experiment_running', lambda: self.get_db_setting('experiment_running'))
+        if exp_running == "True":
+            return True
+        elif exp_running == "False":
+            return False
+        else:
+            raise Exception("Something has gone wrong!")
+
+    async def get_version_status(self, version):
+        algorithm = mm.current_state().name
+        if self.db_pool is None:
+            return mm.store.get_version_status(algorithm, str(version))
+        rows = await self.query("SELECT status FROM {}.versions WHERE algo_name = %s AND version = %s ORDER BY ver_no DESC LIMIT 1".format(mm.db_name),
+                                (algorithm, str(version)))
+        return rows[0][0] if rows else None
+
+    async def read_db_exp_no(self):
+        algorithm = mm.current_state().name
+        if self.db_pool is None:
+            return mm.store.get_latest_experiment_no(algorithm)
+        rows = await self.query("SELECT MAX(experiment_no) FROM {}.experiments WHERE algo_name = %s".format(mm.db_name),
+                                (algorithm,))
+        return int(rows[0][0])
+
+    async def get_exp_no(self):
+        return await self.cached('experiment_no', self.read_db_exp_no)
+
+    async def get_latest_algo_version(self):
+        # The first read fetches the version on a thread, later reads come from memory
+        algorithm = mm.current_state().name
+        if not mm.version_poller.is_tracking(algorithm):
+            return await self.run_sync(mm.get_latest_algo_version)
+        return mm.version_poller.latest_versions[algorithm]
+
+    async def pipe(self, version, input):
+        '''
+        Call a version of the target algorithm, like client.algo(...).pipe(input).result
+        '''
+        if isinstance(input, bytes):
+            content_type, data = "application/octet-stream", input
+        elif isinstance(input, str):
+            content_type, data = "text/plain", input.encode("utf-8")
+        else:
+            content_type, data = "application/json", json.dumps(input).encode("utf-8")
+        url = "{}/v1/algo/{}/{}".format(self.api_address, mm.current_state().name, version)
+        headers = {"Content-Type": content_type, "Authorization": "Simple {}".format(self.api_key)}
+        with mm.metrics.timer("downstream_call"):
+            async with self.session.post(url, data=data, headers=headers) as response:
+                body = await response.json(content_type=None)
+        if "error" in body:
+            error = body["error"]
+            raise AlgorithmException(error.get("message"), error.get("stacktrace"), error.get("error_type"))
+        if body.get("metadata", {}).get("content_type") == "binary":
+            return base64.b64decode(body["result"])
+        return body["result"]
+
+    async def get_routing(self):
+        '''
+        Async version of model_monitoring.get_routing(): returns (stable_version, experiment_version),
+        where experiment_version is None if there isn't a new deployed version
+        '''
+        # If there isn't a "latest-stable-version" yet, update it to the latest algorithm version.
+        db_stable_version = await self.get_db_stable_version()
+        if not db_stable_version:
+            async with self._setup_lock:
+                if not await self.get_db_stable_version():
+                    latest_algo_version = await self.get_latest_algo_version()
+                    if not latest_algo_version:
+                        raise Exception("There isn't a published version of the model {} yet.".format(mm.current_state().name))
+                    await self.run_sync(mm.set_first_stable_version, latest_algo_version)
+            db_stable_version = await self.get_db_stable_version()
+        latest_algo_version = await self.get_latest_algo_version()
+        # If there isn't a new deployed version, just called the DB stable version
+        if latest_algo_version is None or not latest_algo_version > db_stable_version:
+            return db_stable_version, None
+        # Create a new experiment if it isn't already running, once per process
+        if not await self.is_experiment_running():
+            # A version that already failed its experiment isn't experimented again
+            status = await self.cached('version_status:{}'.format(latest_algo_version),
+                                       lambda: self.get_version_status(latest_algo_version))
+            if status == "fail":
+                return db_stable_version, None
+            async with self._setup_lock:
+                # Another task may have started the experiment while this one waited, or the resolver
+                # may have ended it, so the settings are read again from the DB
+                mm.current_state().settings_cache.invalidate()
+                db_stable_version = await self.get_db_stable_version()
+                if not latest_algo_version > db_stable_version:
+                    return db_stable_version, None
+                if not await self.is_experiment_running():
+                    # Only a version that was never deployed gets an experiment, not one already promoted or failed
+                    if await self.get_version_status(latest_algo_version) is not None:
+                        return db_stable_version, None
+                    await self.run_sync(mm.start_experiment, db_stable_version, latest_algo_version)
+        return db_stable_version, await self.get_db_exp_version()
+
+    async def call_algorithm(self, input):
+        async with self._slots:
+            db_stable_version, db_exp_version = await self.get_routing()
+            if db_exp_version is None:
+                result, _ = await self.cached_pipe(db_stable_version, input)
+                return result
+            if mm.experiment_mode == "shadow":
+                # Always serve the stable version, the experiment version only sees a mirrored copy
+                result, algo_timing = await self.cached_pipe(db_stable_version, input)
+                if algo_timing is not None:
+                    self.mirror_request(input, db_stable_version, db_exp_version, algo_timing)
+                return result
+            test_type = mm.pick_test_type()
+            breaker = mm.current_state().breaker
+            if (test_type == "experiment" and not breaker.allow()) or (test_type == "stable" and breaker.is_open()):
+                # Not a stable sample, neither arm counts toward experiment_count while the breaker is open
+                result, _ = await self.cached_pipe(db_stable_version, input)
+                return result
+            if test_type == "experiment":
+                return await self.call_experiment(input, db_stable_version, db_exp_version)
+            test_version = db_stable_version
+            result, algo_timing = await self.cached_pipe(test_version, input)
+            if algo_timing is not None:
+                await self.register_samples([(test_version, algo_timing)])
+            return result
+
+    async def call_algorithm_batch(self, inputs):
+        '''
+        Async version of model_monitoring.call_algorithm_batch(): routing is resolved once, the inputs
+        are called concurrently (each holding an in-flight slot), and {"result": ...} or {"error": ...}
+        is returned per input, in input order
+        '''
+        async with self._slots:
+            db_stable_version, db_exp_version = await self.get_routing()
+        mm.metrics.count("batch_items", len(inputs))
+        if db_exp_version is None or mm.experiment_mode == "shadow":
+            test_versions = [db_stable_version] * len(inputs)
+        else:
+            test_versions = [mm.pick_batch_version(db_stable_version, db_exp_version) for _ in inputs]
+
+        async def call(input, test_version):
+            async with self._slots:
+                try:
+                    if test_version == db_exp_version:
+                        # Experiment timings are registered by call_experiment() itself
+                        return {"result": await self.call_experiment(input, db_stable_version, db_exp_version)}, None
+                    result, algo_timing = await self.cached_pipe(db_stable_version, input)
+                except Exception as err:
+                    return {"error": str(err)}, None
+                return {"result": result}, algo_timing
+
+        responses = await asyncio.gather(*[call(input, test_version) for input, test_version in zip(inputs, test_versions)])
+        if db_exp_version is not None and mm.experiment_mode == "shadow":
+            for input, (_, algo_timing) in zip(inputs, responses):
+                if algo_timing is not None:
+                    self.mirror_request(input, db_stable_version, db_exp_version, algo_timing)
+        elif db_exp_version is not None:
+            # Register all stable test data at once
+            await self.register_samples([(test_version, algo_timing)
+                                         for (_, algo_timing), test_version in zip(responses, test_versions)
+                                         if algo_timing is not None and test_version is not None])
+        return [response for response, _ in responses]
+
+    async def register_samples(self, timings):
+        '''
+        Queue (version, timing) samples, only waiting on a thread if the sample buffer is full,
+        then signal the experiment resolver
+        '''
+        experiment_no = await self.get_exp_no()
+        for test_version, algo_timing in timings:
+            sample = mm.new_sample(experiment_no, test_version, algo_timing)
+            if not mm.sample_writer.try_add(sample):
+                await self.run_sync(mm.sample_writer.add, sample)
+        mm.experiment_resolver.notify()
+
+    def mirror_request(self, input, db_stable_version, db_exp_version, stable_timing):
+        '''
+        In shadow mode, call the experiment version with the same input on a background task
+        and record both timings. Returns False if the request isn't mirrored.
+        '''
+        if random.random() >= mm.shadow_fraction or self._shadow_slots.locked():
+            return False
+        self.run_in_background(self.call_shadow(input, db_stable_version, db_exp_version, stable_timing))
+        return True
+
+    def run_in_background(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        # Keep a reference, so the task isn't garbage collected before it finishes
+        self._background_tasks.add(task)
+        task.add_done_callback(self.forget_task)
+        return task
+
+    def forget_task(self, task):
+        self._background_tasks.discard(task)
+        # Nobody may be waiting for a losing hedged call, so retrieve its error here
+        if not task.cancelled():
+            task.exception()
+
+    async def get_hedge_budget(self):
+        if mm.hedge_budget is not None:
+            return mm.hedge_budget
+        settings_cache = mm.current_state().settings_cache
+        hit, budget, generation = settings_cache.lookup('hedge_budget')
+        if not hit:
+            budget = await self.run_sync(mm.read_stable_p95)
+            # Until the stable version has enough samples, like model_monitoring.get_hedge_budget()
+            settings_cache.store('hedge_budget', budget, generation, None if budget is not None else mm.sample_flush_interval)
+        return mm.experiment_threshold if budget is None else budget
+
+    async def timed_pipe(self, version, input):
+        algo_start = time.time()
+        result = await self.pipe(version, input)
+        return result, time.time() - algo_start
+
+    async def cached_pipe(self, version, input):
+        '''
+        Async version of model_monitoring.cached_pipe(), returns (result, algo_timing or None for a cache hit)
+        '''
+        key = mm.response_cache.key(version, input)
+        hit, result = mm.response_cache.get(key)
+        if hit:
+            return result, None
+        result, algo_timing = await self.timed_pipe(version, input)
+        mm.response_cache.put(key, result)
+        return result, algo_timing
+
+    async def run_experiment(self, input, db_exp_version, budget, cache_key):
+        breaker = mm.current_state().breaker
+        try:
+            result, algo_timing = await self.timed_pipe(db_exp_version, input)
+        except Exception:
+            breaker.record(True, False)
+            raise
+        breaker.record(False, algo_timing > budget)
+        mm.response_cache.put(cache_key, result)
+        await self.register_samples([(db_exp_version, algo_timing)])
+        return result
+
+    async def call_experiment(self, input, db_stable_version, db_exp_version):
+        '''
+        Async version of model_monitoring.call_experiment(): hedge with the stable version when the
+        experiment version fails or is slower than the hedge budget, and return the first response
+        '''
+        cache_key = mm.response_cache.key(db_exp_version, input)
+        hit, result = mm.response_cache.get(cache_key)
+        if hit:
+            return result
+        budget = await self.get_hedge_budget()
+        if not mm.hedge_requests:
+            return await self.run_experiment(input, db_exp_version, budget, cache_key)
+        experiment_task = self.run_in_background(self.run_experiment(input, db_exp_version, budget, cache_key))
+        done, _ = await asyncio.wait({experiment_task}, timeout=budget)
+        if done and experiment_task.exception() is None:
+            return experiment_task.result()
+        pending = {experiment_task, self.run_in_background(self.pipe(db_stable_version, input))}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+        raise experiment_task.exception()
+
+    async def call_shadow(self, input, db_stable_version, db_exp_version, stable_timing):
+        async with self._shadow_slots:
+            breaker = mm.current_state().breaker
+            try:
+                algo_start = time.time()
+                try:
+                    await self.pipe(db_exp_version, input)
+                except Exception:
+                    # Failed mirrored calls count toward the breaker's error rate, like failed live calls
+                    breaker.record(True, False)
+                    raise
+                breaker.record(False, False)
+                experiment_timing = time.time() - algo_start
+                await self.register_samples([(db_stable_version, stable_timing), (db_exp_version, experiment_timing)])
+            except Exception as err:
+                mm.log(0, "Mirrored call to version {} failed: {}", db_exp_version, err)
+
+monitor = None
+monitor_lock = None
+
+async def get_monitor():
+    global monitor, monitor_lock
+    if monitor_lock is None:
+        monitor_lock = asyncio.Lock()
+    async with monitor_lock:
+        if monitor is None:
+            # Check if the DB tables have been created
+            if not mm.check_db_init:
+                await asyncio.get_running_loop().run_in_executor(None, mm.init_database)
+            monitor = await AsyncMonitor.create()
+        # Check if DB has been initialized for the target algorithm
+        if not mm.current_state().db_init:
+            await monitor.run_sync(mm.init_algorithm)
+    return monitor
+
+async def apply(input):
+    # {"algorithm": name, "input": ...} calls another monitored algorithm than mm.algo_name
+    algorithm, input = mm.parse_target(input)
+    with mm.targeting(algorithm):
+        async_monitor = await get_monitor()
+        # {"batch": [input, ...]} calls the target algorithm once per input, like the sync apply()
+        if isinstance(input, dict) and list(input) == ["batch"] and isinstance(input["batch"], list):
+            with mm.metrics.timer("batch_request"):
+                return await async_monitor.call_algorithm_batch(input["batch"])
+        with mm.metrics.timer("request"):
+            return await async_monitor.call_algorithm(input)
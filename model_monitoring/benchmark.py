@@ -0,0 +1,300 @@
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import model_monitoring as mm
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Measure the latency model_monitoring.apply() adds on top of the target algorithm")
+    parser.add_argument("-b", "--backend", choices=["memory", "sqlite"], default="memory",
+                        help="Local store used instead of MySQL")
+    parser.add_argument("-n", "--requests", type=int, default=2000,
+                        help="Measured requests per scenario and concurrency level")
+    parser.add_argument("-l", "--model_latency", type=float, default=0.002,
+                        help="Seconds the stub algorithm takes per call")
+    parser.add_argument("-c", "--concurrency", default="1,2,4,8,16",
+                        help="Comma separated numbers of concurrent callers for the throughput runs")
+    parser.add_argument("-e", "--experiment_count", type=int, default=200,
+                        help="experiment_count used in the resolution scenario")
+    parser.add_argument("-w", "--start_window", type=int, default=20,
+                        help="Requests measured after each new version in the start scenario")
+    parser.add_argument("-o", "--output", default=None,
+                        help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+    return args
+
+def main(args=None):
+    if isinstance(args, type(None)):
+        args = parse_arguments()
+    report = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+request_thread = threading.local()
+
+class StubResponse:
+    def __init__(self, result):
+        self.result = result
+
+class StubAlgo:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def pipe(self, input):
+        time.sleep(self.client.model_latency)
+        return StubResponse(input)
+
+    def versions(self, published=True):
+        return StubVersions(self.client.versions)
+
+class StubVersions:
+    def __init__(self, versions):
+        self.results = [{"version_info": {"semantic_version": version}} for version in versions]
+
+class StubClient:
+    '''
+    Stands in for Algorithmia.client(): every version answers after model_latency seconds,
+    and publish() adds a new version for the version poller to find
+    '''
+    def __init__(self, model_latency):
+        self.model_latency = model_latency
+        self.versions = []
+
+    def algo(self, name):
+        return StubAlgo(self, name)
+
+    def publish(self):
+        version = "1.{}.0".format(len(self.versions))
+        self.versions.append(version)
+        mm.version_poller.refresh()
+        return version
+
+class CountingStore:
+    '''
+    Wraps a store and counts its calls, separately for request threads and background threads.
+    Calls made while the benchmark sets up a scenario aren't counted. With MySQLStore every call
+    is one DB round trip (two for set_version_status and a contended acquire_lease).
+    '''
+    def __init__(self, store):
+        self.store = store
+        self.request_calls = 0
+        self.background_calls = 0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self.store, name)
+        if not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            role = getattr(request_thread, "role", "background")
+            with self._lock:
+                if role == "request":
+                    self.request_calls += 1
+                elif role == "background":
+                    self.background_calls += 1
+            return attr(*args, **kwargs)
+        return counted
+
+    def reset_counts(self):
+        with self._lock:
+            self.request_calls = 0
+            self.background_calls = 0
+
+def percentiles(values):
+    ordered = sorted(values)
+    if not ordered:
+        return {}
+
+    def at(q):
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+    return {
+        "mean": sum(ordered) / len(ordered),
+        "p50": at(0.5),
+        "p90": at(0.9),
+        "p99": at(0.99),
+        "max": ordered[-1]
+    }
+
+def to_ms(stats):
+    return {name: value * 1000 for name, value in stats.items()}
+
+def reset_state(args, client, sqlite_dir):
+    '''
+    Point model_monitoring at a fresh local store with one published version
+    '''
+    mm.sample_writer.flush()
+    if args.backend == "sqlite":
+        path = os.path.join(sqlite_dir, "benchmark-{}.sqlite3".format(time.time()))
+        backing_store = mm.SQLiteStore(path)
+    else:
+        backing_store = mm.MemoryStore()
+    mm.store = CountingStore(backing_store)
+    mm.algorithm_states.clear()
+    mm.check_db_init = False
+    client.versions = []
+    client.publish()
+    # The first request records the stable version
+    mm.apply(None)
+
+@contextlib.contextmanager
+def thread_role(role):
+    previous = getattr(request_thread, "role", "background")
+    request_thread.role = role
+    try:
+        yield
+    finally:
+        request_thread.role = previous
+
+def timed_apply(input):
+    with thread_role("request"):
+        request_start = time.perf_counter()
+        mm.apply(input)
+        return time.perf_counter() - request_start
+
+def measure(requests, concurrency):
+    '''
+    Run requests through apply() on concurrency threads, returns (latencies, wall_time)
+    '''
+    wall_start = time.perf_counter()
+    if concurrency == 1:
+        latencies = [timed_apply(i) for i in range(requests)]
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = list(executor.map(timed_apply, range(requests)))
+    return latencies, time.perf_counter() - wall_start
+
+def summarize(latencies, wall_time, baseline, concurrency):
+    mm.sample_writer.flush()
+    requests = len(latencies)
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "overhead_ms": to_ms(percentiles([latency - baseline for latency in latencies])),
+        "db_round_trips_per_request": mm.store.request_calls / requests,
+        "background_db_round_trips_per_request": mm.store.background_calls / requests,
+        "throughput_rps": requests / wall_time
+    }
+
+def measure_baseline(client, requests):
+    '''
+    Median time of a bare stub call, subtracted from every request to get the orchestrator's overhead
+    '''
+    algo = client.algo(mm.algo_name)
+    timings = []
+    for i in range(requests):
+        call_start = time.perf_counter()
+        algo.pipe(i)
+        timings.append(time.perf_counter() - call_start)
+    return percentiles(timings)
+
+def run_steady(args, client, sqlite_dir, baseline, concurrency=1):
+    reset_state(args, client, sqlite_dir)
+    mm.store.reset_counts()
+    latencies, wall_time = measure(args.requests, concurrency)
+    return summarize(latencies, wall_time, baseline, concurrency)
+
+def run_start(args, client, sqlite_dir, baseline):
+    '''
+    Publish a new version, then measure the first start_window requests, which start the experiment
+    '''
+    reset_state(args, client, sqlite_dir)
+    mm.experiment_count = sys.maxsize
+    latencies = []
+    wall_time = 0
+    mm.store.reset_counts()
+    while len(latencies) < args.requests:
+        version = client.publish()
+        window, window_time = measure(min(args.start_window, args.requests - len(latencies)), 1)
+        latencies.extend(window)
+        wall_time += window_time
+        # End the experiment outside of the measurement, so the next version starts a new one
+        with thread_role("setup"):
+            mm.promote_experiment_version(version, mm.read_db_exp_no())
+    return summarize(latencies, wall_time, baseline, 1)
+
+def run_active(args, client, sqlite_dir, baseline, concurrency=1):
+    reset_state(args, client, sqlite_dir)
+    mm.experiment_count = sys.maxsize
+    client.publish()
+    # Start the experiment before measuring
+    measure(args.start_window, 1)
+    mm.store.reset_counts()
+    latencies, wall_time = measure(args.requests, concurrency)
+    return summarize(latencies, wall_time, baseline, concurrency)
+
+def run_resolution(args, client, sqlite_dir, baseline):
+    '''
+    Run experiments of experiment_count samples back to back; experiments are resolved
+    by the background resolver while requests keep coming in
+    '''
+    reset_state(args, client, sqlite_dir)
+    mm.experiment_count = args.experiment_count
+    latencies = []
+    resolutions = 0
+    mm.store.reset_counts()
+    wall_start = time.perf_counter()
+    client.publish()
+    for i in range(args.requests):
+        latencies.append(timed_apply(i))
+        with thread_role("setup"):
+            # Experiment 1 records the first stable version, experiment n + 1 is the n-th new version
+            if mm.store.get_setting(mm.algo_name, "experiment_running") == "False" and mm.read_db_exp_no() > resolutions + 1:
+                resolutions += 1
+                client.publish()
+    report = summarize(latencies, time.perf_counter() - wall_start, baseline, 1)
+    report["resolutions"] = resolutions
+    return report
+
+def run(args):
+    '''
+    Run every scenario against a stub Algorithmia client and a local store,
+    and return the machine-readable report
+    '''
+    client = StubClient(args.model_latency)
+    concurrency_levels = [int(level) for level in args.concurrency.split(",")]
+    original_client, original_store, original_count = mm.client, mm.store, mm.experiment_count
+    mm.client = client
+    # Resolve as soon as an experiment is decided, the production default waits a second between checks
+    mm.experiment_resolver.check_interval = 0.01
+    with tempfile.TemporaryDirectory() as sqlite_dir:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), thread_role("setup"):
+            baseline = measure_baseline(client, min(args.requests, 200))
+            scenarios = {
+                "steady": run_steady(args, client, sqlite_dir, baseline["p50"]),
+                "start": run_start(args, client, sqlite_dir, baseline["p50"]),
+                "active": run_active(args, client, sqlite_dir, baseline["p50"]),
+                "resolution": run_resolution(args, client, sqlite_dir, baseline["p50"])
+            }
+            throughput = {"steady": [], "active": []}
+            for concurrency in concurrency_levels:
+                throughput["steady"].append(run_steady(args, client, sqlite_dir, baseline["p50"], concurrency))
+                throughput["active"].append(run_active(args, client, sqlite_dir, baseline["p50"], concurrency))
+            mm.sample_writer.flush()
+    mm.client, mm.store, mm.experiment_count = original_client, original_store, original_count
+    return {
+        "config": {
+            "backend": args.backend,
+            "requests": args.requests,
+            "model_latency_ms": args.model_latency * 1000,
+            "experiment_mode": mm.experiment_mode,
+            "hedge_requests": mm.hedge_requests,
+            "settings_cache_ttl": mm.settings_cache_ttl
+        },
+        "baseline_model_call_ms": to_ms(baseline),
+        "scenarios": scenarios,
+        "throughput_vs_concurrency": throughput
+    }
+
+if __name__ == "__main__":
+    main()
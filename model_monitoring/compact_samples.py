@@ -0,0 +1,50 @@
+import argparse
+import time
+import model_monitoring as mm
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Roll up old raw samples of finished experiments into hourly statistics")
+    parser.add_argument("-r", "--retention_days", type=float, default=mm.sample_retention_days,
+                        help="Raw samples younger than this are kept")
+    parser.add_argument("-b", "--batch_rows", type=int, default=mm.compaction_batch_rows,
+                        help="Number of samples compacted per transaction")
+    parser.add_argument("-p", "--pause", type=float, default=0.1,
+                        help="Seconds to wait between batches, to leave room for live traffic")
+    parser.add_argument("-a", "--archive", action="store_true", default=mm.compaction_archive,
+                        help="Copy compacted samples to experimentSamplesArchive instead of only deleting them")
+    args = parser.parse_args()
+    return args
+
+def main(args=None):
+    if isinstance(args, type(None)):
+        args = parse_arguments()
+    compact(args)
+
+def compact(args):
+    '''
+    Compact raw samples in batches until none are left. Experiment statistics used to resolve
+    experiments aren't touched, and get_hourly_stats() returns the same before and after. The
+    job can be stopped and re-run at any time; the compaction lease keeps concurrent runs apart.
+    '''
+    mm.init_database()
+    lease_seconds = max(mm.resolve_lease_seconds, 10 * args.pause)
+    if not mm.acquire_lease("compaction", mm.lease_owner, lease_seconds):
+        print("Another compaction is running")
+        return
+    try:
+        total = 0
+        while True:
+            compacted = mm.compact_samples(args.retention_days, args.batch_rows, args.archive)
+            if not compacted:
+                break
+            total += compacted
+            print("Compacted {} samples ({} so far)".format(compacted, total))
+            # Extend the lease while batches keep coming
+            mm.acquire_lease("compaction", mm.lease_owner, lease_seconds)
+            time.sleep(args.pause)
+        print("Compacted {} samples older than {} days".format(total, args.retention_days))
+    finally:
+        mm.release_lease("compaction", mm.lease_owner)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import argparse
+import json
+import time
+import model_monitoring as mm
+from datetime import datetime
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Upgrade the model monitoring database to the current schema version")
+    parser.add_argument("-c", "--chunk_size", type=int, default=5000,
+                        help="Number of experimentData rows copied per transaction")
+    parser.add_argument("-p", "--pause", type=float, default=0.1,
+                        help="Seconds to wait between chunks, to leave room for live traffic")
+    args = parser.parse_args()
+    return args
+
+def main(args=None):
+    if isinstance(args, type(None)):
+        args = parse_arguments()
+    migrate(args)
+
+def get_legacy_bounds(cursor):
+    '''
+    Returns the (min, max) request_no of the schema version 1 experimentData table,
+    or None if there is nothing to copy
+    '''
+    cursor.execute("SHOW TABLES FROM {} LIKE 'experimentData'".format(mm.db_name))
+    if cursor.fetchone() is None:
+        return None
+    cursor.execute("SELECT MIN(request_no), MAX(request_no) FROM {}.experimentData".format(mm.db_name))
+    first, last = cursor.fetchone()
+    if first is None:
+        return None
+    return first, last
+
+def has_column(cursor, table_name, column):
+    cursor.execute("SHOW COLUMNS FROM {}.{} LIKE %s".format(mm.db_name, table_name), (column,))
+    return cursor.fetchone() is not None
+
+def add_algorithm_columns(cursor):
+    '''
+    Key versions, metaData and experiments by algorithm (schema version 3). Existing rows, and rows
+    written by orchestrators that haven't been upgraded yet, belong to mm.algo_name.
+    Returns the number of altered tables.
+    '''
+    keys = {
+        "versions": "ADD KEY `algo_version` (`algo_name`, `ver_no`)",
+        "experiments": "ADD KEY `algo_experiment` (`algo_name`, `experiment_no`)",
+        "metaData": "MODIFY `setting` varchar(64) NOT NULL, ADD UNIQUE KEY `algo_setting` (`algo_name`, `setting`)"
+    }
+    altered = 0
+    for table_name, key in keys.items():
+        if has_column(cursor, table_name, "algo_name"):
+            continue
+        print("Adding algo_name to {}".format(table_name))
+        # One ALTER per table, so a re-run after a failure picks up where it stopped
+        cursor.execute("ALTER TABLE {}.{} ADD COLUMN `algo_name` varchar(255) NOT NULL DEFAULT %s, {}".format(
+            mm.db_name, table_name, key), (mm.algo_name,))
+        altered += 1
+    # schema_version belongs to the whole database
+    cursor.execute("UPDATE {}.metaData SET algo_name = '' WHERE setting = 'schema_version'".format(mm.db_name))
+    return altered
+
+def backfill_chunk(cnx, start, end):
+    '''
+    Copy the experimentData rows with start <= request_no < end into experimentSamples,
+    and add them to the experiment statistics. Rows copied by an earlier run are skipped.
+    Returns the number of copied rows.
+    '''
+    cursor = cnx.cursor()
+    try:
+        # Plain SELECTs are consistent reads, so experimentData is never locked
+        cursor.execute(
+            "SELECT request_no, experiment_no, algo_version, data, date FROM {}.experimentData"
+            " WHERE request_no >= %s AND request_no < %s".format(mm.db_name),
+            (start, end))
+        rows = cursor.fetchall()
+        cursor.execute(
+            "SELECT legacy_request_no FROM {}.experimentSamples"
+            " WHERE legacy_request_no >= %s AND legacy_request_no < %s".format(mm.db_name),
+            (start, end))
+        copied = set(row[0] for row in cursor.fetchall())
+        samples = []
+        for request_no, experiment_no, algo_version, data, day in rows:
+            if request_no in copied:
+                continue
+            created_at = datetime.combine(day, datetime.min.time())
+            samples.append((experiment_no, algo_version[:64], json.loads(data)["algo_timing"], created_at, request_no))
+        if not samples:
+            return 0
+        cnx.start_transaction()
+        try:
+            cursor.executemany(
+                "INSERT INTO {}.experimentSamples (experiment_no, algo_version, algo_timing, created_at, legacy_request_no)"
+                " VALUES (%s, %s, %s, %s, %s)".format(mm.db_name),
+                samples)
+            mm.add_sample_stats(cursor, samples)
+            cnx.commit()
+        except Exception:
+            cnx.rollback()
+            raise
+        return len(samples)
+    finally:
+        cursor.close()
+
+def migrate(args):
+    '''
+    Upgrade a schema version 1 or 2 database in place, while the orchestrator keeps serving traffic.
+    New tables are created first, then versions, metaData and experiments get their algo_name
+    column, then experimentData is copied into experimentSamples in small chunks. The migration
+    can be stopped and re-run; only one migration should run at a time. Deploy orchestrators
+    that monitor more than one algorithm only once it has finished.
+    '''
+    if not isinstance(mm.store, mm.MySQLStore):
+        print("SQLite files are upgraded when they are opened, MySQL databases are the only ones to migrate")
+        return
+    print("Creating missing tables")
+    mm.store.init_store()
+    with mm.db_pool.connection() as cnx:
+        cursor = cnx.cursor(buffered=True)
+        if not add_algorithm_columns(cursor):
+            print("Tables are already keyed by algorithm")
+        bounds = get_legacy_bounds(cursor)
+        cursor.close()
+        if bounds is None:
+            print("No experimentData rows to copy")
+        else:
+            first, last = bounds
+            total = 0
+            for start in range(first, last + 1, args.chunk_size):
+                end = start + args.chunk_size
+                total += backfill_chunk(cnx, start, end)
+                print("Copied request_no {}-{} ({} rows so far)".format(start, min(end, last + 1) - 1, total))
+                time.sleep(args.pause)
+            print("Copied {} experimentData rows into experimentSamples".format(total))
+    mm.store.set_settings('', {"schema_version": str(mm.db_schema_version)})
+    print("Database {} is now at schema version {}".format(mm.db_name, mm.db_schema_version))
+
+if __name__ == "__main__":
+    main()
@@ -1,86 +1,1634 @@
 import Algorithmia
 import semantic_version
 import mysql.connector
-import pandas as pd
 import random
 import time
+import sys
+import math
 import json
+import bisect
+import hashlib
+import os
+import queue
+import socket
+import sqlite3
+import uuid
+import atexit
+import contextvars
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
+from abc import ABC, abstractmethod
 from mysql.connector import errorcode
-from dbrequests import Database
-from datetime import date
+from datetime import date, datetime, timedelta
 
 algo_name = 'username/algoname'
+algo_names = [algo_name] # Target algorithms requests may name with {"algorithm": name, "input": ...}, requests without a name call algo_name
 
-experiment_count = 1000 # Number of samples that needs to be collected to run an experiment
+experiment_count = 1000 # Number of samples that needs to be collected to run an experiment (at most, with sequential testing)
 experiment_threshold = 2 # An algorithm request shouldn't take more than 2 seconds on average
+experiment_metric = 'mean' # Experiment latency statistic compared against experiment_threshold: 'mean', 'p50', 'p95' or 'p99'
+sketch_relative_accuracy = 0.01 # Latency percentiles are reported within 1% of their true value
 experiment_split = 0.5 # Call experimental model 50% of the time
+experiment_mode = 'split' # 'split' sends each request to one version, 'shadow' always serves the stable version and mirrors requests to the experiment version
+shadow_fraction = 1.0 # Fraction of requests mirrored to the experiment version in shadow mode
+shadow_workers = 4 # Maximum number of concurrent mirrored calls per process, requests beyond that aren't mirrored
+hedge_requests = True # In split mode, also call the stable version when the experiment version is slower than the hedge budget, and return the first response
+hedge_budget = None # Seconds to wait for the experiment version before hedging, None uses the stable version's observed p95
+hedge_workers = 16 # Threads per process for experiment calls and for hedged stable calls
+breaker_window = 50 # Number of recent experiment calls the circuit breaker looks at
+breaker_min_calls = 10 # Recent experiment calls needed before the circuit breaker can open
+breaker_error_rate = 0.5 # Stop routing to the experiment version when this share of recent calls failed
+breaker_slow_rate = 0.5 # Stop routing to the experiment version when this share of recent calls exceeded the hedge budget
+breaker_cooldown = 30 # Seconds without experiment traffic after the circuit breaker opens, before a trial call is let through
+sequential_testing = True # End an experiment early once the latency difference between both versions is clear
+sequential_min_samples = 100 # Samples per version before an experiment can end early
+sequential_margin = 0.1 # Seconds the experiment version may be slower on average than the stable version and still be promoted
+sequential_alpha = 0.05 # Chance of failing a version early that isn't slower than stable + sequential_margin
+sequential_beta = 0.05 # Chance of promoting a version early that is slower than stable + sequential_margin
+log_verbosity = 1 # 0 only prints errors, 1 also experiment and version events, 2 also a few lines per request
+metrics_log_interval = None # Seconds between metrics snapshots printed to the log, None turns them off
+settings_cache_ttl = 30 # Seconds a metaData setting is served from memory before it is read from the DB again
 check_db_init = False
 
+db_backend = 'mysql' # Where experiments are stored: 'mysql', 'sqlite' (a local file at sqlite_path) or 'memory' (this process only, lost on restart)
+sqlite_path = 'model_monitoring.sqlite3'
+memory_max_samples = 100000 # Raw samples kept by the in-memory store, the latency statistics always cover every sample
 db_name = 'ModelMonitoring'
 db_username = 'db_username'
 db_password = 'db_password'
 db_host = 'XXX.us-east-1.rds.amazonaws.com'
-
-creds = {
-    "user": db_username,
-    "password": db_password,
-    "host": db_host,
-    "db": db_name
-}
+db_schema_version = 3 # Schema version created by init_database(), see migrate_schema.py for upgrading older databases
+db_pool_size = 5 # Maximum number of open DB connections per process
+db_pool_timeout = 10 # Seconds to wait for a free DB connection before giving up
+db_pool_ping_after = 30 # Seconds a connection can sit idle before it is health checked on checkout
+sample_batch_rows = 100 # Write buffered experiment samples once this many are waiting
+sample_flush_interval = 0.5 # Seconds between writes of buffered experiment samples
+sample_buffer_size = 10000 # Maximum number of buffered samples before requests have to wait
+sample_buffer_timeout = 1 # Seconds a request waits for room in a full buffer before its sample is dropped
+sample_write_attempts = 3 # Times a batch of samples is written before it is dropped, so a batch the DB keeps rejecting can't block the buffer
+version_poll_interval = 10 # Seconds between checks for a newly published version of the algorithm
+version_poll_jitter = 0.2 # Up to this fraction of the interval is randomly added to each wait, so workers don't poll in lockstep
+sample_retention_days = 30 # Raw samples of finished experiments older than this are rolled up per hour and deleted by compact_samples.py
+compaction_batch_rows = 5000 # Raw samples rolled up and deleted per compaction transaction
+compaction_archive = False # Copy compacted raw samples to experimentSamplesArchive instead of only deleting them
+batch_workers = 8 # Maximum number of concurrent downstream calls per process for batch requests
+response_cache_enabled = False # Serve repeated inputs from memory, only for deterministic algorithms
+response_cache_entries = 10000 # Maximum number of cached responses per process
+response_cache_ttl = 300 # Seconds a cached response is served before the algorithm is called again
+response_cache_max_bytes = 64 * 1024 * 1024 # Approximate memory cap of the cached responses per process
+resolve_on_requests = True # Set to False when resolve_worker.py resolves experiments in its own process
+resolve_check_interval = 1 # Minimum seconds between two checks whether the running experiment can be resolved
+resolve_lease_seconds = 60 # Seconds a process holds the lease for resolving an experiment before another process may take over
 
 db_tables = {}
+# versions, metaData and experiments are keyed by the target algorithm since schema version 3.
+# Experiment numbers are unique across algorithms, so the sample and statistics tables aren't.
 db_tables['versions'] = (
     "CREATE TABLE `versions` ("
     "  `ver_no` int(11) NOT NULL AUTO_INCREMENT,"
+    "  `algo_name` varchar(255) NOT NULL,"
     "  `version` varchar(65535) NOT NULL,"
     "  `status` ENUM('success', 'fail', 'experiment') NOT NULL,"
     "  `date` date NOT NULL,"
-    "  PRIMARY KEY (`ver_no`)"
+    "  PRIMARY KEY (`ver_no`),"
+    "  KEY `algo_version` (`algo_name`, `ver_no`)"
     ") ENGINE=InnoDB"
 )
 
 db_tables['metaData']= (
     "CREATE TABLE `metaData` ("
     "  `id` int(11) NOT NULL AUTO_INCREMENT,"
-    "  `setting` varchar(65535) NOT NULL,"
+    "  `algo_name` varchar(255) NOT NULL,"
+    "  `setting` varchar(64) NOT NULL,"
     "  `val` varchar(65535),"
-    "  PRIMARY KEY (`id`)"
+    "  PRIMARY KEY (`id`),"
+    "  UNIQUE KEY `algo_setting` (`algo_name`, `setting`)"
     ") ENGINE=InnoDB"
 )
 
 db_tables['experiments'] = (
 "CREATE TABLE `experiments` ("
     "  `experiment_no` int(11) NOT NULL AUTO_INCREMENT,"
+    "  `algo_name` varchar(255) NOT NULL,"
     "  `prev_ver` varchar(65535) NOT NULL,"
     "  `next_ver` varchar(65535) NOT NULL,"
     "  `start_date` date,"
     "  `end_date` date,"
     "  `promoted` BOOL,"
-    "  PRIMARY KEY (`experiment_no`)"
+    "  PRIMARY KEY (`experiment_no`),"
+    "  KEY `algo_experiment` (`algo_name`, `experiment_no`)"
     ") ENGINE=InnoDB"
 )
 
-db_tables['experimentData'] = (
-"CREATE TABLE `experimentData` ("
-    "  `request_no` int(11) NOT NULL AUTO_INCREMENT,"
-    "  `data` varchar(65535) NOT NULL,"
-    "  `date` date NOT NULL,"
-    "  `algo_version` varchar(65535) NOT NULL,"
+# One row per experiment call. Schema version 1 stored these in `experimentData`,
+# with the timing as JSON and an unindexed varchar(65535) version.
+db_tables['experimentSamples'] = (
+"CREATE TABLE `experimentSamples` ("
+    "  `request_no` bigint NOT NULL AUTO_INCREMENT,"
     "  `experiment_no` int(11) NOT NULL,"
+    "  `algo_version` varchar(64) NOT NULL,"
+    "  `algo_timing` double NOT NULL,"
+    "  `created_at` datetime(3) NOT NULL,"
+    "  `legacy_request_no` int(11),"
     "  PRIMARY KEY (`request_no`),"
+    "  KEY `experiment_version` (`experiment_no`, `algo_version`),"
+    "  UNIQUE KEY `legacy_request_no` (`legacy_request_no`),"
+    "  FOREIGN KEY (`experiment_no`) REFERENCES experiments(experiment_no)"
+    "  ON DELETE CASCADE"
+    ") ENGINE=InnoDB"
+)
+
+# Running latency statistics per experiment arm, updated together with experimentSamples
+db_tables['experimentStats'] = (
+"CREATE TABLE `experimentStats` ("
+    "  `experiment_no` int(11) NOT NULL,"
+    "  `algo_version` varchar(64) NOT NULL,"
+    "  `samples` int(11) NOT NULL DEFAULT 0,"
+    "  `latency_sum` double NOT NULL DEFAULT 0,"
+    "  `latency_sum_sq` double NOT NULL DEFAULT 0,"
+    "  `latency_min` double,"
+    "  `latency_max` double,"
+    "  PRIMARY KEY (`experiment_no`, `algo_version`),"
     "  FOREIGN KEY (`experiment_no`) REFERENCES experiments(experiment_no)"
     "  ON DELETE CASCADE"
     ") ENGINE=InnoDB"
 )
 
+# Quantile sketch buckets per experiment arm, see LatencyStats
+db_tables['experimentSketch'] = (
+"CREATE TABLE `experimentSketch` ("
+    "  `experiment_no` int(11) NOT NULL,"
+    "  `algo_version` varchar(64) NOT NULL,"
+    "  `bucket` int(11) NOT NULL,"
+    "  `samples` int(11) NOT NULL DEFAULT 0,"
+    "  PRIMARY KEY (`experiment_no`, `algo_version`, `bucket`),"
+    "  FOREIGN KEY (`experiment_no`) REFERENCES experiments(experiment_no)"
+    "  ON DELETE CASCADE"
+    ") ENGINE=InnoDB"
+)
+
+# Hourly latency statistics and sketches of compacted samples, see compact_samples.py
+db_tables['experimentHourlyStats'] = (
+"CREATE TABLE `experimentHourlyStats` ("
+    "  `experiment_no` int(11) NOT NULL,"
+    "  `algo_version` varchar(64) NOT NULL,"
+    "  `hour` datetime NOT NULL,"
+    "  `samples` int(11) NOT NULL DEFAULT 0,"
+    "  `latency_sum` double NOT NULL DEFAULT 0,"
+    "  `latency_sum_sq` double NOT NULL DEFAULT 0,"
+    "  `latency_min` double,"
+    "  `latency_max` double,"
+    "  PRIMARY KEY (`experiment_no`, `algo_version`, `hour`),"
+    "  FOREIGN KEY (`experiment_no`) REFERENCES experiments(experiment_no)"
+    "  ON DELETE CASCADE"
+    ") ENGINE=InnoDB"
+)
+
+db_tables['experimentHourlySketch'] = (
+"CREATE TABLE `experimentHourlySketch` ("
+    "  `experiment_no` int(11) NOT NULL,"
+    "  `algo_version` varchar(64) NOT NULL,"
+    "  `hour` datetime NOT NULL,"
+    "  `bucket` int(11) NOT NULL,"
+    "  `samples` int(11) NOT NULL DEFAULT 0,"
+    "  PRIMARY KEY (`experiment_no`, `algo_version`, `hour`, `bucket`),"
+    "  FOREIGN KEY (`experiment_no`) REFERENCES experiments(experiment_no)"
+    "  ON DELETE CASCADE"
+    ") ENGINE=InnoDB"
+)
+
+# Compacted raw samples, when compaction_archive is set
+db_tables['experimentSamplesArchive'] = (
+"CREATE TABLE `experimentSamplesArchive` ("
+    "  `request_no` bigint NOT NULL,"
+    "  `experiment_no` int(11) NOT NULL,"
+    "  `algo_version` varchar(64) NOT NULL,"
+    "  `algo_timing` double NOT NULL,"
+    "  `created_at` datetime(3) NOT NULL,"
+    "  PRIMARY KEY (`request_no`),"
+    "  KEY `experiment_version` (`experiment_no`, `algo_version`)"
+    ") ENGINE=InnoDB"
+)
+
+# Short-lived locks shared by all processes, e.g. the one taken to resolve an experiment
+db_tables['leases'] = (
+"CREATE TABLE `leases` ("
+    "  `name` varchar(64) NOT NULL,"
+    "  `owner` varchar(128) NOT NULL,"
+    "  `expires_at` datetime(3) NOT NULL,"
+    "  PRIMARY KEY (`name`)"
+    ") ENGINE=InnoDB"
+)
+
 client = Algorithmia.client("simXXXXXXXX")
 
-def get_latest_algo_version():
+def log(level, message, *args, end='\n'):
+    '''
+    Print message.format(*args) if level <= log_verbosity. The message is only formatted when it is printed.
+    '''
+    if level <= log_verbosity:
+        print(message.format(*args) if args else message, end=end)
+
+class Histogram:
+    '''
+    Latency histogram with fixed buckets, recorded like a Prometheus histogram:
+    counts[i] holds the observations <= bounds[i], the last count the ones above every bound
+    '''
+    bounds = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q):
+        '''
+        Upper bound of the bucket holding the q-quantile, None above the last bound
+        '''
+        if not self.count:
+            return None
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return bound
+        return None
+
+class Metrics:
+    '''
+    Per-stage timers and counters of the orchestrator, cheap enough to record on every request.
+    render() returns them in the Prometheus text format, snapshot() as a dict, and
+    start_reporter() prints a snapshot every interval seconds.
+    '''
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.histograms = {}
+        self.counters = {}
+        self.components = {}
+        self._lock = threading.Lock()
+        self._reporter = None
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def register(self, component, get_stats):
+        '''
+        Export the stats dict returned by get_stats() as gauges, e.g. the connection pool counters
+        '''
+        self.components[component] = get_stats
+
+    def snapshot(self):
+        with self._lock:
+            stages = {stage: {"count": histogram.count, "sum": histogram.total,
+                              "p50": histogram.quantile(0.5), "p99": histogram.quantile(0.99)}
+                      for stage, histogram in self.histograms.items()}
+            counters = dict(self.counters)
+        components = {component: get_stats() for component, get_stats in self.components.items()}
+        return {"stages": stages, "counters": counters, "components": components}
+
+    def render(self):
+        '''
+        Returns all metrics in the Prometheus text exposition format
+        '''
+        with self._lock:
+            histograms = [(stage, list(histogram.counts), histogram.count, histogram.total)
+                          for stage, histogram in sorted(self.histograms.items())]
+            counters = sorted(self.counters.items())
+        lines = ["# HELP {}_stage_seconds Time spent in each stage of a request".format(self.prefix),
+                 "# TYPE {}_stage_seconds histogram".format(self.prefix)]
+        for stage, counts, count, total in histograms:
+            cumulative = 0
+            for bound, bucket_count in zip(Histogram.bounds + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append('{}_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(self.prefix, stage, bound, cumulative))
+            lines.append('{}_stage_seconds_sum{{stage="{}"}} {}'.format(self.prefix, stage, total))
+            lines.append('{}_stage_seconds_count{{stage="{}"}} {}'.format(self.prefix, stage, count))
+        for name, value in counters:
+            lines.append("# TYPE {}_{}_total counter".format(self.prefix, name))
+            lines.append("{}_{}_total {}".format(self.prefix, name, value))
+        for component, get_stats in sorted(self.components.items()):
+            for stat, value in sorted(get_stats().items()):
+                lines.append("# TYPE {}_{}_{} gauge".format(self.prefix, component, stat))
+                lines.append("{}_{}_{} {}".format(self.prefix, component, stat, value))
+        return "\n".join(lines) + "\n"
+
+    def start_reporter(self, interval):
+        if self._reporter is not None:
+            return
+        with self._lock:
+            if self._reporter is None:
+                self._reporter = threading.Thread(target=self._report, args=(interval,), name="metrics-reporter", daemon=True)
+                self._reporter.start()
+
+    def _report(self, interval):
+        while True:
+            time.sleep(interval)
+            print("Metrics: {}".format(json.dumps(self.snapshot(), sort_keys=True)))
+
+metrics = Metrics("model_monitoring")
+
+class SettingsCache:
+    '''
+    In-process TTL cache for the metaData settings read on every request.
+    Writers call invalidate() so this process sees its own changes immediately;
+    other processes pick them up once the TTL expires.
+    '''
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        '''
+        Returns (hit, value, generation); pass generation to store() after loading a miss
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() < entry[1]:
+                return True, entry[0], self._generation
+            return False, None, self._generation
+
+    def store(self, key, value, generation, ttl=None):
+        '''
+        Cache value for ttl seconds, the cache's ttl by default
+        '''
+        with self._lock:
+            # Don't store a value that was loaded before an invalidation
+            if generation == self._generation:
+                self._entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+
+    def get(self, key, loader):
+        hit, value, generation = self.lookup(key)
+        if hit:
+            return value
+        metrics.count("settings_cache_misses")
+        value = loader()
+        self.store(key, value, generation)
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self._generation += 1
+            if keys:
+                for key in keys:
+                    self._entries.pop(key, None)
+            else:
+                self._entries.clear()
+
+class ConnectionPool:
+    '''
+    Bounded pool of MySQL connections shared by every DB helper.
+    Connections that sat idle are pinged on checkout and reconnected if they dropped.
+    '''
+    def __init__(self, size, timeout, ping_after, **connect_args):
+        self.size = size
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self.connect_args = connect_args
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self.stats = {"checkouts": 0, "waits": 0, "wait_time": 0.0, "connects": 0, "reconnects": 0, "discards": 0}
+
+    def _count(self, stat, value=1):
+        with self._lock:
+            self.stats[stat] += value
+
+    def _connect(self):
+        self._count("connects")
+        return mysql.connector.connect(autocommit=True, **self.connect_args)
+
+    def checkout(self):
+        if not self._slots.acquire(blocking=False):
+            self._count("waits")
+            wait_start = time.monotonic()
+            acquired = self._slots.acquire(timeout=self.timeout)
+            self._count("wait_time", time.monotonic() - wait_start)
+            if not acquired:
+                raise Exception("Timed out after {}s waiting for a DB connection".format(self.timeout))
+        self._count("checkouts")
+        try:
+            try:
+                cnx, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if time.monotonic() - last_used >= self.ping_after:
+                try:
+                    cnx.ping(reconnect=True, attempts=2, delay=0.1)
+                except mysql.connector.Error:
+                    self._count("reconnects")
+                    self.close_quietly(cnx)
+                    return self._connect()
+            return cnx
+        except Exception:
+            self._slots.release()
+            raise
+
+    def checkin(self, cnx):
+        self._idle.put((cnx, time.monotonic()))
+        self._slots.release()
+
+    def discard(self, cnx):
+        self._count("discards")
+        self.close_quietly(cnx)
+        self._slots.release()
+
+    def close_quietly(self, cnx):
+        try:
+            cnx.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        cnx = self.checkout()
+        try:
+            yield cnx
+        except mysql.connector.Error:
+            # The connection may be broken or mid-result, don't hand it to the next caller
+            self.discard(cnx)
+            raise
+        except BaseException:
+            self.checkin(cnx)
+            raise
+        else:
+            self.checkin(cnx)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats["idle"] = self._idle.qsize()
+        return stats
+
+db_pool = ConnectionPool(db_pool_size, db_pool_timeout, db_pool_ping_after,
+                         user=db_username, password=db_password, host=db_host)
+
+def send_query(query, params=None):
+    '''
+    Run a query on a pooled connection and return its rows as tuples
+    '''
+    with db_pool.connection() as cnx:
+        cursor = cnx.cursor(buffered=True)
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        cursor.close()
+    return rows
+
+def read_frame(query, params=None):
+    '''
+    Run an analysis query and return the rows as a DataFrame.
+    pandas is only imported here, so the orchestrator itself starts without it.
+    '''
+    import pandas as pd
+    with db_pool.connection() as cnx:
+        cursor = cnx.cursor(buffered=True)
+        cursor.execute(query, params)
+        columns = [column[0] for column in cursor.description]
+        rows = cursor.fetchall()
+        cursor.close()
+    return pd.DataFrame(rows, columns=columns)
+
+def send_many(statement, rows):
+    '''
+    Run a parameterized write statement for every row in one executemany() call on a pooled connection.
+    Plain INSERTs are sent as a single multi-row INSERT.
+    '''
+    with db_pool.connection() as cnx:
+        cursor = cnx.cursor()
+        cursor.executemany(statement, rows)
+        cursor.close()
+
+def send_statement(statement, params=None):
+    '''
+    Run a single write statement on a pooled connection and return the number of affected rows
+    '''
+    with db_pool.connection() as cnx:
+        cursor = cnx.cursor()
+        cursor.execute(statement, params)
+        rowcount = cursor.rowcount
+        cursor.close()
+    return rowcount
+
+class LatencyStats:
+    '''
+    Mergeable latency statistics for one experiment arm: count, sum, sum of squares,
+    min/max, and a log-bucketed quantile sketch. Bucket i holds the values in
+    (gamma^(i-1), gamma^i], so quantiles are within relative_accuracy of the true value.
+    Two LatencyStats are merged by adding them up, which is also how they are stored.
+    '''
+    min_latency = 1e-6
+
+    def __init__(self, relative_accuracy=sketch_relative_accuracy):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.buckets = {}
+
+    @classmethod
+    def from_totals(cls, count, total, total_sq, minimum, maximum):
+        '''
+        Rebuild LatencyStats from an experimentStats row, without the sketch
+        '''
+        stats = cls()
+        stats.count = int(count)
+        stats.total = float(total)
+        stats.total_sq = float(total_sq)
+        stats.minimum = minimum
+        stats.maximum = maximum
+        return stats
+
+    def add(self, latency):
+        self.count += 1
+        self.total += latency
+        self.total_sq += latency * latency
+        self.minimum = latency if self.minimum is None else min(self.minimum, latency)
+        self.maximum = latency if self.maximum is None else max(self.maximum, latency)
+        bucket = int(math.ceil(math.log(max(latency, self.min_latency)) / self.log_gamma))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.total_sq += other.total_sq
+        for bound in (other.minimum, other.maximum):
+            if bound is not None:
+                self.minimum = bound if self.minimum is None else min(self.minimum, bound)
+                self.maximum = bound if self.maximum is None else max(self.maximum, bound)
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        return self
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    @property
+    def variance(self):
+        if self.count < 2:
+            return 0.0
+        return max(self.total_sq - self.total * self.total / self.count, 0.0) / (self.count - 1)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen > rank:
+                estimate = 2 * self.gamma ** bucket / (self.gamma + 1)
+                return min(max(estimate, self.minimum), self.maximum)
+        return self.maximum
+
+    def metric(self, name):
+        '''
+        Returns 'mean' or a percentile such as 'p95'
+        '''
+        if name == 'mean':
+            return self.mean
+        return self.quantile(float(name[1:]) / 100)
+
+    def summary(self):
+        return {
+            "samples": self.count,
+            "mean": self.mean,
+            "std": math.sqrt(self.variance),
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99)
+        }
+
+def group_sample_stats(samples, by_hour=False):
+    '''
+    Group (experiment_no, algo_version, algo_timing, created_at) samples into per-arm LatencyStats,
+    or per arm and hour with by_hour. Returns (stats_rows, sketch_rows) sorted by arm, so
+    concurrent writers can't deadlock. Rows start with (experiment_no, algo_version[, hour]).
+    '''
+    arm_stats = {}
+    for sample in samples:
+        arm = (sample[0], sample[1], to_hour(sample[3])) if by_hour else (sample[0], sample[1])
+        if arm not in arm_stats:
+            arm_stats[arm] = LatencyStats()
+        arm_stats[arm].add(sample[2])
+    stats_rows = []
+    sketch_rows = []
+    for arm in sorted(arm_stats):
+        stats = arm_stats[arm]
+        stats_rows.append(arm + (stats.count, stats.total, stats.total_sq, stats.minimum, stats.maximum))
+        for bucket in sorted(stats.buckets):
+            sketch_rows.append(arm + (bucket, stats.buckets[bucket]))
+    return stats_rows, sketch_rows
+
+def to_hour(created_at):
+    '''
+    Truncate a sample time (a datetime or an ISO string) to the hour
+    '''
+    if isinstance(created_at, str):
+        created_at = datetime.fromisoformat(created_at)
+    return created_at.replace(minute=0, second=0, microsecond=0)
+
+def add_hourly_stats(stats, hourly_rows, sketch_rows):
+    '''
+    Merge experimentHourlyStats-like rows (algo_version, hour, samples, sum, sum_sq, min, max) and
+    sketch rows (algo_version, hour, bucket, samples) into a {(algo_version, hour): LatencyStats} dict
+    '''
+    for algo_version, hour, *totals in hourly_rows:
+        stats.setdefault((algo_version, to_hour(hour)), LatencyStats()).merge(LatencyStats.from_totals(*totals))
+    for algo_version, hour, bucket, count in sketch_rows:
+        buckets = stats[(algo_version, to_hour(hour))].buckets
+        buckets[int(bucket)] = buckets.get(int(bucket), 0) + int(count)
+    return stats
+
+def add_sample_stats(cursor, samples):
+    '''
+    Add (experiment_no, algo_version, algo_timing, ...) samples to the per-arm latency statistics
+    '''
+    stats_rows, sketch_rows = group_sample_stats(samples)
+    cursor.executemany(
+        "INSERT INTO {}.experimentStats"
+        " (experiment_no, algo_version, samples, latency_sum, latency_sum_sq, latency_min, latency_max)"
+        " VALUES (%s, %s, %s, %s, %s, %s, %s)"
+        " ON DUPLICATE KEY UPDATE samples = samples + VALUES(samples),"
+        " latency_sum = latency_sum + VALUES(latency_sum),"
+        " latency_sum_sq = latency_sum_sq + VALUES(latency_sum_sq),"
+        " latency_min = LEAST(COALESCE(latency_min, VALUES(latency_min)), VALUES(latency_min)),"
+        " latency_max = GREATEST(COALESCE(latency_max, VALUES(latency_max)), VALUES(latency_max))".format(db_name),
+        stats_rows)
+    cursor.executemany(
+        "INSERT INTO {}.experimentSketch (experiment_no, algo_version, bucket, samples) VALUES (%s, %s, %s, %s)"
+        " ON DUPLICATE KEY UPDATE samples = samples + VALUES(samples)".format(db_name),
+        sketch_rows)
+
+class Store(ABC):
+    '''
+    Storage interface for the versions, metaData, experiments and experiment sample tables.
+    The orchestrator only talks to the module level store, so MySQLStore, SQLiteStore and
+    MemoryStore can be swapped without touching the request path.
+    Settings, experiments and versions belong to a target algorithm; database wide settings
+    like schema_version use the algorithm ''. Experiment numbers are unique across algorithms.
+    Samples are (experiment_no, algo_version, algo_timing, created_at) tuples.
+    A store that doesn't implement every abstract method can't be created.
+    '''
+    @abstractmethod
+    def init_store(self):
+        '''
+        Create missing tables. Returns True if the store was empty and needs its schema version.
+        '''
+        raise NotImplementedError
+
+    def get_schema_version(self):
+        '''
+        Returns the raw schema_version setting, None if it isn't set
+        '''
+        return self.get_setting('', 'schema_version')
+
+    @abstractmethod
+    def get_algorithms(self):
+        '''
+        Returns the names of all algorithms with metaData
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_setting(self, algorithm, setting):
+        '''
+        Returns the raw metaData value of a setting, None if it isn't set
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_settings(self, algorithm, values):
+        '''
+        Insert or update the metaData settings in a {setting: value} dict
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def init_settings(self, algorithm, values):
+        '''
+        Insert the metaData settings in a {setting: value} dict that aren't set yet
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_latest_experiment_no(self, algorithm):
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_experiment(self, algorithm, prev_ver, next_ver, start_date, end_date, promoted):
+        raise NotImplementedError
+
+    @abstractmethod
+    def end_experiment(self, experiment_no, end_date, promoted):
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_version(self, algorithm, version, status, day):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_version_status(self, algorithm, version, status):
+        '''
+        Update the status of the latest row of a version
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_version_status(self, algorithm, version):
+        '''
+        Returns the status of the latest row of a version, None if it was never deployed
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def write_samples(self, samples):
+        '''
+        Store samples and add them to the per-arm latency statistics, atomically
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_experiment_stats(self, experiment_no, with_sketch=True):
+        '''
+        Returns {algo_version: LatencyStats} for every version arm in an experiment
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def compact_samples(self, cutoff, batch_rows, archive):
+        '''
+        Roll up to batch_rows raw samples of finished experiments created before cutoff into the
+        hourly statistics, and delete (or with archive, move) them in the same transaction.
+        Returns the number of compacted samples, 0 once there is nothing left to compact.
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_hourly_stats(self, experiment_no):
+        '''
+        Returns {(algo_version, hour): LatencyStats} over the rolled up and the raw samples of an experiment
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def acquire_lease(self, name, owner, seconds):
+        '''
+        Take the lease called name for seconds, or extend it if owner already holds it.
+        Returns False while another owner holds an unexpired lease.
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def release_lease(self, name, owner):
+        raise NotImplementedError
+
+class MySQLStore(Store):
+    '''
+    Store on the MySQL database configured by the db_* globals, through db_pool
+    '''
+    def init_store(self):
+        db_created = False
+        with db_pool.connection() as conn:
+            curr = conn.cursor(buffered=True)
+            # First, create database if it doesn't exist
+            try:
+                curr.execute("USE {}".format(db_name))
+            except mysql.connector.Error as err:
+                log(1, "Database {} does not exists.", db_name)
+                if err.errno == errorcode.ER_BAD_DB_ERROR:
+                    create_database(curr)
+                    log(1, "Database {} created successfully.", db_name)
+                    conn.database = db_name
+                    db_created = True
+                else:
+                    log(0, "{}", err)
+            # Second, create all tables that are going to be used.
+            # This also adds tables introduced after the database was first created.
+            for table_name in db_tables:
+                table_description = db_tables[table_name]
+                try:
+                    log(1, "Creating table {}: ", table_name, end='')
+                    curr.execute(table_description)
+                except mysql.connector.Error as err:
+                    if err.errno == errorcode.ER_TABLE_EXISTS_ERROR:
+                        log(1, "already exists.")
+                    else:
+                        log(0, err.msg)
+                else:
+                    log(1, "OK")
+            curr.close()
+        return db_created
+
+    def get_schema_version(self):
+        # Works on every schema version, older ones have no algo_name column
+        rows = send_query("""SELECT MAX(CAST(val AS UNSIGNED)) FROM {}.metaData WHERE setting = 'schema_version';""".format(db_name))
+        if not rows or rows[0][0] is None:
+            return None
+        return str(rows[0][0])
+
+    def get_algorithms(self):
+        rows = send_query("""SELECT DISTINCT algo_name FROM {}.metaData WHERE algo_name != '';""".format(db_name))
+        return [row[0] for row in rows]
+
+    def get_setting(self, algorithm, setting):
+        rows = send_query("""SELECT val FROM {}.metaData WHERE algo_name = %s AND setting = %s;""".format(db_name), (algorithm, setting))
+        if not rows:
+            return None
+        return rows[0][0]
+
+    def set_settings(self, algorithm, values):
+        send_many("""INSERT INTO {}.metaData (algo_name, setting, val) VALUES (%s, %s, %s)
+                     ON DUPLICATE KEY UPDATE val = VALUES(val);""".format(db_name),
+                  [(algorithm, setting, val) for setting, val in values.items()])
+
+    def init_settings(self, algorithm, values):
+        send_many("""INSERT IGNORE INTO {}.metaData (algo_name, setting, val) VALUES (%s, %s, %s);""".format(db_name),
+                  [(algorithm, setting, val) for setting, val in values.items()])
+
+    def get_latest_experiment_no(self, algorithm):
+        rows = send_query("""SELECT MAX(experiment_no) FROM {}.experiments WHERE algo_name = %s;""".format(db_name), (algorithm,))
+        return int(rows[0][0])
+
+    def add_experiment(self, algorithm, prev_ver, next_ver, start_date, end_date, promoted):
+        send_statement("""INSERT INTO {}.experiments (algo_name, prev_ver, next_ver, start_date, end_date, promoted)
+                          VALUES (%s, %s, %s, %s, %s, %s);""".format(db_name),
+                       (algorithm, prev_ver, next_ver, start_date, end_date, promoted))
+
+    def end_experiment(self, experiment_no, end_date, promoted):
+        send_statement("""UPDATE {}.experiments SET end_date = %s, promoted = %s WHERE experiment_no = %s;""".format(db_name),
+                       (end_date, promoted, experiment_no))
+
+    def add_version(self, algorithm, version, status, day):
+        send_statement("""INSERT INTO {}.versions (algo_name, version, status, date) VALUES (%s, %s, %s, %s);""".format(db_name),
+                       (algorithm, version, status, day))
+
+    def set_version_status(self, algorithm, version, status):
+        send_statement("""UPDATE {}.versions SET status = %s WHERE algo_name = %s AND version = %s
+                          ORDER BY ver_no DESC LIMIT 1;""".format(db_name),
+                       (status, algorithm, version))
+
+    def get_version_status(self, algorithm, version):
+        rows = send_query("""SELECT status FROM {}.versions WHERE algo_name = %s AND version = %s
+                             ORDER BY ver_no DESC LIMIT 1;""".format(db_name), (algorithm, version))
+        return rows[0][0] if rows else None
+
+    def write_samples(self, samples):
+        '''
+        Insert samples with a single multi-row INSERT, and add them to the per-arm
+        latency statistics in the same transaction
+        '''
+        with db_pool.connection() as cnx:
+            cursor = cnx.cursor()
+            cnx.start_transaction()
+            try:
+                cursor.executemany(
+                    "INSERT INTO {}.experimentSamples (experiment_no, algo_version, algo_timing, created_at)"
+                    " VALUES (%s, %s, %s, %s)".format(db_name),
+                    samples)
+                add_sample_stats(cursor, samples)
+                cnx.commit()
+            except Exception:
+                cnx.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def get_experiment_stats(self, experiment_no, with_sketch=True):
+        arm_stats = {}
+        rows = send_query("""SELECT algo_version, samples, latency_sum, latency_sum_sq, latency_min, latency_max
+                             FROM {}.experimentStats WHERE experiment_no = %s;""".format(db_name), (experiment_no,))
+        for row in rows:
+            arm_stats[row[0]] = LatencyStats.from_totals(*row[1:])
+        if not with_sketch:
+            return arm_stats
+        rows = send_query("""SELECT algo_version, bucket, samples FROM {}.experimentSketch WHERE experiment_no = %s;""".format(db_name),
+                          (experiment_no,))
+        for algo_version, bucket, count in rows:
+            if algo_version in arm_stats:
+                arm_stats[algo_version].buckets[int(bucket)] = int(count)
+        return arm_stats
+
+    def compact_samples(self, cutoff, batch_rows, archive):
+        with db_pool.connection() as cnx:
+            cursor = cnx.cursor(buffered=True)
+            try:
+                cursor.execute("SELECT experiment_no FROM {}.experiments WHERE end_date IS NOT NULL".format(db_name))
+                samples = []
+                # One experiment at a time, so the (experiment_no, algo_version) index is used
+                for (experiment_no,) in cursor.fetchall():
+                    cursor.execute(
+                        "SELECT request_no, experiment_no, algo_version, algo_timing, created_at FROM {}.experimentSamples"
+                        " WHERE experiment_no = %s AND created_at < %s LIMIT %s".format(db_name),
+                        (experiment_no, cutoff, batch_rows))
+                    samples = cursor.fetchall()
+                    if samples:
+                        break
+                if not samples:
+                    return 0
+                cnx.start_transaction()
+                try:
+                    add_hourly_sample_stats(cursor, [sample[1:] for sample in samples])
+                    if archive:
+                        cursor.executemany(
+                            "INSERT IGNORE INTO {}.experimentSamplesArchive (request_no, experiment_no, algo_version, algo_timing, created_at)"
+                            " VALUES (%s, %s, %s, %s, %s)".format(db_name),
+                            samples)
+                    request_nos = [sample[0] for sample in samples]
+                    cursor.execute(
+                        "DELETE FROM {}.experimentSamples WHERE request_no IN ({})".format(db_name, ", ".join(["%s"] * len(request_nos))),
+                        request_nos)
+                    cnx.commit()
+                except Exception:
+                    cnx.rollback()
+                    raise
+                return len(samples)
+            finally:
+                cursor.close()
+
+    def get_hourly_stats(self, experiment_no):
+        stats = add_hourly_stats({}, send_query(
+            """SELECT algo_version, hour, samples, latency_sum, latency_sum_sq, latency_min, latency_max
+               FROM {}.experimentHourlyStats WHERE experiment_no = %s;""".format(db_name), (experiment_no,)), send_query(
+            """SELECT algo_version, hour, bucket, samples FROM {}.experimentHourlySketch WHERE experiment_no = %s;""".format(db_name),
+            (experiment_no,)))
+        stats_rows, sketch_rows = group_sample_stats(send_query(
+            """SELECT experiment_no, algo_version, algo_timing, created_at FROM {}.experimentSamples WHERE experiment_no = %s;""".format(db_name),
+            (experiment_no,)), by_hour=True)
+        return add_hourly_stats(stats, [row[1:] for row in stats_rows], [row[1:] for row in sketch_rows])
+
+    def acquire_lease(self, name, owner, seconds):
+        if send_statement("""INSERT IGNORE INTO {}.leases (name, owner, expires_at) VALUES (%s, %s, NOW(3) + INTERVAL %s SECOND);""".format(db_name),
+                          (name, owner, seconds)):
+            return True
+        # The row lock taken by the UPDATE makes sure only one process takes over an expired lease
+        return send_statement("""UPDATE {}.leases SET owner = %s, expires_at = NOW(3) + INTERVAL %s SECOND
+                                 WHERE name = %s AND (owner = %s OR expires_at < NOW(3));""".format(db_name),
+                              (owner, seconds, name, owner)) > 0
+
+    def release_lease(self, name, owner):
+        send_statement("""DELETE FROM {}.leases WHERE name = %s AND owner = %s;""".format(db_name), (name, owner))
+
+sqlite_tables = {}
+sqlite_tables['versions'] = (
+    "CREATE TABLE IF NOT EXISTS versions ("
+    "  ver_no INTEGER PRIMARY KEY AUTOINCREMENT,"
+    "  algo_name TEXT NOT NULL,"
+    "  version TEXT NOT NULL,"
+    "  status TEXT NOT NULL CHECK (status IN ('success', 'fail', 'experiment')),"
+    "  date TEXT NOT NULL"
+    ")"
+)
+sqlite_tables['metaData'] = (
+    "CREATE TABLE IF NOT EXISTS metaData ("
+    "  id INTEGER PRIMARY KEY,"
+    "  algo_name TEXT NOT NULL,"
+    "  setting TEXT NOT NULL,"
+    "  val TEXT"
+    ")"
+)
+sqlite_tables['metaDataIndex'] = (
+    "CREATE UNIQUE INDEX IF NOT EXISTS algo_setting ON metaData (algo_name, setting)"
+)
+sqlite_tables['experiments'] = (
+    "CREATE TABLE IF NOT EXISTS experiments ("
+    "  experiment_no INTEGER PRIMARY KEY AUTOINCREMENT,"
+    "  algo_name TEXT NOT NULL,"
+    "  prev_ver TEXT NOT NULL,"
+    "  next_ver TEXT NOT NULL,"
+    "  start_date TEXT,"
+    "  end_date TEXT,"
+    "  promoted INTEGER"
+    ")"
+)
+sqlite_tables['experimentsIndex'] = (
+    "CREATE INDEX IF NOT EXISTS algo_experiment ON experiments (algo_name, experiment_no)"
+)
+sqlite_tables['experimentSamples'] = (
+    "CREATE TABLE IF NOT EXISTS experimentSamples ("
+    "  request_no INTEGER PRIMARY KEY AUTOINCREMENT,"
+    "  experiment_no INTEGER NOT NULL REFERENCES experiments(experiment_no) ON DELETE CASCADE,"
+    "  algo_version TEXT NOT NULL,"
+    "  algo_timing REAL NOT NULL,"
+    "  created_at TEXT NOT NULL"
+    ")"
+)
+sqlite_tables['experimentSamplesIndex'] = (
+    "CREATE INDEX IF NOT EXISTS experiment_version ON experimentSamples (experiment_no, algo_version)"
+)
+sqlite_tables['experimentStats'] = (
+    "CREATE TABLE IF NOT EXISTS experimentStats ("
+    "  experiment_no INTEGER NOT NULL REFERENCES experiments(experiment_no) ON DELETE CASCADE,"
+    "  algo_version TEXT NOT NULL,"
+    "  samples INTEGER NOT NULL DEFAULT 0,"
+    "  latency_sum REAL NOT NULL DEFAULT 0,"
+    "  latency_sum_sq REAL NOT NULL DEFAULT 0,"
+    "  latency_min REAL,"
+    "  latency_max REAL,"
+    "  PRIMARY KEY (experiment_no, algo_version)"
+    ")"
+)
+sqlite_tables['experimentSketch'] = (
+    "CREATE TABLE IF NOT EXISTS experimentSketch ("
+    "  experiment_no INTEGER NOT NULL REFERENCES experiments(experiment_no) ON DELETE CASCADE,"
+    "  algo_version TEXT NOT NULL,"
+    "  bucket INTEGER NOT NULL,"
+    "  samples INTEGER NOT NULL DEFAULT 0,"
+    "  PRIMARY KEY (experiment_no, algo_version, bucket)"
+    ")"
+)
+sqlite_tables['experimentHourlyStats'] = (
+    "CREATE TABLE IF NOT EXISTS experimentHourlyStats ("
+    "  experiment_no INTEGER NOT NULL REFERENCES experiments(experiment_no) ON DELETE CASCADE,"
+    "  algo_version TEXT NOT NULL,"
+    "  hour TEXT NOT NULL,"
+    "  samples INTEGER NOT NULL DEFAULT 0,"
+    "  latency_sum REAL NOT NULL DEFAULT 0,"
+    "  latency_sum_sq REAL NOT NULL DEFAULT 0,"
+    "  latency_min REAL,"
+    "  latency_max REAL,"
+    "  PRIMARY KEY (experiment_no, algo_version, hour)"
+    ")"
+)
+sqlite_tables['experimentHourlySketch'] = (
+    "CREATE TABLE IF NOT EXISTS experimentHourlySketch ("
+    "  experiment_no INTEGER NOT NULL REFERENCES experiments(experiment_no) ON DELETE CASCADE,"
+    "  algo_version TEXT NOT NULL,"
+    "  hour TEXT NOT NULL,"
+    "  bucket INTEGER NOT NULL,"
+    "  samples INTEGER NOT NULL DEFAULT 0,"
+    "  PRIMARY KEY (experiment_no, algo_version, hour, bucket)"
+    ")"
+)
+sqlite_tables['experimentSamplesArchive'] = (
+    "CREATE TABLE IF NOT EXISTS experimentSamplesArchive ("
+    "  request_no INTEGER PRIMARY KEY,"
+    "  experiment_no INTEGER NOT NULL,"
+    "  algo_version TEXT NOT NULL,"
+    "  algo_timing REAL NOT NULL,"
+    "  created_at TEXT NOT NULL"
+    ")"
+)
+sqlite_tables['leases'] = (
+    "CREATE TABLE IF NOT EXISTS leases ("
+    "  name TEXT PRIMARY KEY,"
+    "  owner TEXT NOT NULL,"
+    "  expires_at REAL NOT NULL"
+    ")"
+)
+
+def to_iso(value):
+    return value.isoformat() if isinstance(value, (date, datetime)) else value
+
+class SQLiteStore(Store):
+    '''
+    Store in a local SQLite file, for single host deployments and CI without a MySQL server.
+    Processes on the same host can share the file; every call in this process goes through one
+    connection guarded by a lock. Dates are stored as ISO strings.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._cnx = sqlite3.connect(path, timeout=db_pool_timeout, isolation_level=None, check_same_thread=False)
+        self._cnx.execute("PRAGMA foreign_keys = ON")
+        self._lock = threading.Lock()
+
+    def execute(self, statement, params=()):
+        with self._lock:
+            cursor = self._cnx.execute(statement, params)
+            rows = cursor.fetchall()
+            rowcount = cursor.rowcount
+            cursor.close()
+        return rows, rowcount
+
+    def init_store(self):
+        with self._lock:
+            # WAL lets readers in other processes work while a sample batch is written
+            self._cnx.execute("PRAGMA journal_mode = WAL")
+            self._upgrade()
+            for table_description in sqlite_tables.values():
+                self._cnx.execute(table_description)
+            return self._cnx.execute("SELECT COUNT(*) FROM metaData").fetchone()[0] == 0
+
+    def _upgrade(self):
+        '''
+        Key the tables of a schema version 2 file by algorithm, its rows belong to algo_name
+        '''
+        columns = [row[1] for row in self._cnx.execute("PRAGMA table_info(metaData)")]
+        if not columns or "algo_name" in columns:
+            return
+        log(1, "Upgrading {} to schema version {}", self.path, db_schema_version)
+        self._cnx.execute("BEGIN IMMEDIATE")
+        try:
+            for table_name in ("metaData", "experiments", "versions"):
+                self._cnx.execute("ALTER TABLE {} ADD COLUMN algo_name TEXT NOT NULL DEFAULT ''".format(table_name))
+                self._cnx.execute("UPDATE {} SET algo_name = ?".format(table_name), (algo_name,))
+            self._cnx.execute("UPDATE metaData SET algo_name = '', val = ? WHERE setting = 'schema_version'", (str(db_schema_version),))
+            self._cnx.execute("COMMIT")
+        except Exception:
+            self._cnx.execute("ROLLBACK")
+            raise
+
+    def get_algorithms(self):
+        rows, _ = self.execute("SELECT DISTINCT algo_name FROM metaData WHERE algo_name != ''")
+        return [row[0] for row in rows]
+
+    def get_setting(self, algorithm, setting):
+        rows, _ = self.execute("SELECT val FROM metaData WHERE algo_name = ? AND setting = ?", (algorithm, setting))
+        return rows[0][0] if rows else None
+
+    def set_settings(self, algorithm, values):
+        with self._lock:
+            self._cnx.executemany(
+                "INSERT INTO metaData (algo_name, setting, val) VALUES (?, ?, ?)"
+                " ON CONFLICT (algo_name, setting) DO UPDATE SET val = excluded.val",
+                [(algorithm, setting, val) for setting, val in values.items()])
+
+    def init_settings(self, algorithm, values):
+        with self._lock:
+            self._cnx.executemany(
+                "INSERT OR IGNORE INTO metaData (algo_name, setting, val) VALUES (?, ?, ?)",
+                [(algorithm, setting, val) for setting, val in values.items()])
+
+    def get_latest_experiment_no(self, algorithm):
+        rows, _ = self.execute("SELECT MAX(experiment_no) FROM experiments WHERE algo_name = ?", (algorithm,))
+        return int(rows[0][0])
+
+    def add_experiment(self, algorithm, prev_ver, next_ver, start_date, end_date, promoted):
+        self.execute("INSERT INTO experiments (algo_name, prev_ver, next_ver, start_date, end_date, promoted) VALUES (?, ?, ?, ?, ?, ?)",
+                     (algorithm, prev_ver, next_ver, to_iso(start_date), to_iso(end_date), promoted))
+
+    def end_experiment(self, experiment_no, end_date, promoted):
+        self.execute("UPDATE experiments SET end_date = ?, promoted = ? WHERE experiment_no = ?",
+                     (to_iso(end_date), promoted, experiment_no))
+
+    def add_version(self, algorithm, version, status, day):
+        self.execute("INSERT INTO versions (algo_name, version, status, date) VALUES (?, ?, ?, ?)",
+                     (algorithm, version, status, to_iso(day)))
+
+    def set_version_status(self, algorithm, version, status):
+        self.execute("UPDATE versions SET status = ? WHERE ver_no = (SELECT MAX(ver_no) FROM versions WHERE algo_name = ? AND version = ?)",
+                     (status, algorithm, version))
+
+    def get_version_status(self, algorithm, version):
+        rows, _ = self.execute("SELECT status FROM versions WHERE algo_name = ? AND version = ? ORDER BY ver_no DESC LIMIT 1",
+                               (algorithm, version))
+        return rows[0][0] if rows else None
+
+    def write_samples(self, samples):
+        stats_rows, sketch_rows = group_sample_stats(samples)
+        with self._lock:
+            self._cnx.execute("BEGIN IMMEDIATE")
+            try:
+                self._cnx.executemany(
+                    "INSERT INTO experimentSamples (experiment_no, algo_version, algo_timing, created_at) VALUES (?, ?, ?, ?)",
+                    [(experiment_no, algo_version, algo_timing, to_iso(created_at))
+                     for experiment_no, algo_version, algo_timing, created_at in samples])
+                self._cnx.executemany(
+                    "INSERT INTO experimentStats"
+                    " (experiment_no, algo_version, samples, latency_sum, latency_sum_sq, latency_min, latency_max)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)"
+                    " ON CONFLICT (experiment_no, algo_version) DO UPDATE SET samples = samples + excluded.samples,"
+                    " latency_sum = latency_sum + excluded.latency_sum,"
+                    " latency_sum_sq = latency_sum_sq + excluded.latency_sum_sq,"
+                    " latency_min = MIN(COALESCE(latency_min, excluded.latency_min), excluded.latency_min),"
+                    " latency_max = MAX(COALESCE(latency_max, excluded.latency_max), excluded.latency_max)",
+                    stats_rows)
+                self._cnx.executemany(
+                    "INSERT INTO experimentSketch (experiment_no, algo_version, bucket, samples) VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT (experiment_no, algo_version, bucket) DO UPDATE SET samples = samples + excluded.samples",
+                    sketch_rows)
+                self._cnx.execute("COMMIT")
+            except Exception:
+                self._cnx.execute("ROLLBACK")
+                raise
+
+    def get_experiment_stats(self, experiment_no, with_sketch=True):
+        arm_stats = {}
+        rows, _ = self.execute(
+            "SELECT algo_version, samples, latency_sum, latency_sum_sq, latency_min, latency_max"
+            " FROM experimentStats WHERE experiment_no = ?", (experiment_no,))
+        for row in rows:
+            arm_stats[row[0]] = LatencyStats.from_totals(*row[1:])
+        if not with_sketch:
+            return arm_stats
+        rows, _ = self.execute("SELECT algo_version, bucket, samples FROM experimentSketch WHERE experiment_no = ?",
+                               (experiment_no,))
+        for algo_version, bucket, count in rows:
+            if algo_version in arm_stats:
+                arm_stats[algo_version].buckets[bucket] = count
+        return arm_stats
+
+    def compact_samples(self, cutoff, batch_rows, archive):
+        with self._lock:
+            samples = self._cnx.execute(
+                "SELECT request_no, experiment_no, algo_version, algo_timing, created_at FROM experimentSamples"
+                " WHERE experiment_no IN (SELECT experiment_no FROM experiments WHERE end_date IS NOT NULL)"
+                " AND created_at < ? LIMIT ?", (to_iso(cutoff), batch_rows)).fetchall()
+            if not samples:
+                return 0
+            stats_rows, sketch_rows = group_sample_stats([sample[1:] for sample in samples], by_hour=True)
+            self._cnx.execute("BEGIN IMMEDIATE")
+            try:
+                self._cnx.executemany(
+                    "INSERT INTO experimentHourlyStats"
+                    " (experiment_no, algo_version, hour, samples, latency_sum, latency_sum_sq, latency_min, latency_max)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+                    " ON CONFLICT (experiment_no, algo_version, hour) DO UPDATE SET samples = samples + excluded.samples,"
+                    " latency_sum = latency_sum + excluded.latency_sum,"
+                    " latency_sum_sq = latency_sum_sq + excluded.latency_sum_sq,"
+                    " latency_min = MIN(COALESCE(latency_min, excluded.latency_min), excluded.latency_min),"
+                    " latency_max = MAX(COALESCE(latency_max, excluded.latency_max), excluded.latency_max)",
+                    [(row[0], row[1], to_iso(row[2])) + row[3:] for row in stats_rows])
+                self._cnx.executemany(
+                    "INSERT INTO experimentHourlySketch (experiment_no, algo_version, hour, bucket, samples) VALUES (?, ?, ?, ?, ?)"
+                    " ON CONFLICT (experiment_no, algo_version, hour, bucket) DO UPDATE SET samples = samples + excluded.samples",
+                    [(row[0], row[1], to_iso(row[2])) + row[3:] for row in sketch_rows])
+                if archive:
+                    self._cnx.executemany(
+                        "INSERT OR IGNORE INTO experimentSamplesArchive (request_no, experiment_no, algo_version, algo_timing, created_at)"
+                        " VALUES (?, ?, ?, ?, ?)", samples)
+                self._cnx.executemany("DELETE FROM experimentSamples WHERE request_no = ?", [(sample[0],) for sample in samples])
+                self._cnx.execute("COMMIT")
+            except Exception:
+                self._cnx.execute("ROLLBACK")
+                raise
+            return len(samples)
+
+    def get_hourly_stats(self, experiment_no):
+        hourly_rows, _ = self.execute(
+            "SELECT algo_version, hour, samples, latency_sum, latency_sum_sq, latency_min, latency_max"
+            " FROM experimentHourlyStats WHERE experiment_no = ?", (experiment_no,))
+        sketch_rows, _ = self.execute("SELECT algo_version, hour, bucket, samples FROM experimentHourlySketch WHERE experiment_no = ?",
+                                      (experiment_no,))
+        stats = add_hourly_stats({}, hourly_rows, sketch_rows)
+        samples, _ = self.execute("SELECT experiment_no, algo_version, algo_timing, created_at FROM experimentSamples WHERE experiment_no = ?",
+                                  (experiment_no,))
+        stats_rows, sketch_rows = group_sample_stats(samples, by_hour=True)
+        return add_hourly_stats(stats, [row[1:] for row in stats_rows], [row[1:] for row in sketch_rows])
+
+    def acquire_lease(self, name, owner, seconds):
+        now = time.time()
+        _, inserted = self.execute("INSERT OR IGNORE INTO leases (name, owner, expires_at) VALUES (?, ?, ?)",
+                                   (name, owner, now + seconds))
+        if inserted:
+            return True
+        _, updated = self.execute("UPDATE leases SET owner = ?, expires_at = ? WHERE name = ? AND (owner = ? OR expires_at < ?)",
+                                  (owner, now + seconds, name, owner, now))
+        return updated > 0
+
+    def release_lease(self, name, owner):
+        self.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+class MemoryStore(Store):
+    '''
+    Store in this process' memory, for benchmarks and tests. Nothing is shared with other
+    processes or kept across restarts. Only the last max_samples raw samples are kept, older
+    ones are rolled up per hour like compacted samples.
+    '''
+    def __init__(self, max_samples=memory_max_samples):
+        self.settings = {}
+        self.experiments = {}
+        self.versions = []
+        self.max_samples = max_samples
+        self.samples = deque()
+        self.arm_stats = {}
+        self.hourly_stats = {}
+        self.leases = {}
+        self._lock = threading.Lock()
+
+    def init_store(self):
+        return not self.settings
+
+    def get_algorithms(self):
+        with self._lock:
+            return sorted(set(algorithm for algorithm, _ in self.settings if algorithm))
+
+    def get_setting(self, algorithm, setting):
+        return self.settings.get((algorithm, setting))
+
+    def set_settings(self, algorithm, values):
+        with self._lock:
+            self.settings.update(((algorithm, setting), val) for setting, val in values.items())
+
+    def init_settings(self, algorithm, values):
+        with self._lock:
+            for setting, val in values.items():
+                self.settings.setdefault((algorithm, setting), val)
+
+    def get_latest_experiment_no(self, algorithm):
+        with self._lock:
+            return max(experiment_no for experiment_no, experiment in self.experiments.items()
+                       if experiment["algo_name"] == algorithm)
+
+    def add_experiment(self, algorithm, prev_ver, next_ver, start_date, end_date, promoted):
+        with self._lock:
+            experiment_no = max(self.experiments, default=0) + 1
+            self.experiments[experiment_no] = {"algo_name": algorithm, "prev_ver": prev_ver, "next_ver": next_ver,
+                                               "start_date": start_date, "end_date": end_date, "promoted": promoted}
+
+    def end_experiment(self, experiment_no, end_date, promoted):
+        with self._lock:
+            self.experiments[experiment_no].update(end_date=end_date, promoted=promoted)
+
+    def add_version(self, algorithm, version, status, day):
+        with self._lock:
+            self.versions.append({"algo_name": algorithm, "version": version, "status": status, "date": day})
+
+    def set_version_status(self, algorithm, version, status):
+        with self._lock:
+            for row in reversed(self.versions):
+                if row["algo_name"] == algorithm and row["version"] == version:
+                    row["status"] = status
+                    return
+
+    def get_version_status(self, algorithm, version):
+        with self._lock:
+            for row in reversed(self.versions):
+                if row["algo_name"] == algorithm and row["version"] == version:
+                    return row["status"]
+
+    def write_samples(self, samples):
+        with self._lock:
+            self.samples.extend(samples)
+            for experiment_no, algo_version, algo_timing in (sample[:3] for sample in samples):
+                arm = (experiment_no, algo_version)
+                if arm not in self.arm_stats:
+                    self.arm_stats[arm] = LatencyStats()
+                self.arm_stats[arm].add(algo_timing)
+            overflow = len(self.samples) - self.max_samples
+            if overflow > 0:
+                self._roll_up([self.samples.popleft() for _ in range(overflow)])
+
+    def _roll_up(self, samples):
+        for experiment_no, algo_version, algo_timing, created_at in samples:
+            arm = (experiment_no, algo_version, to_hour(created_at))
+            if arm not in self.hourly_stats:
+                self.hourly_stats[arm] = LatencyStats()
+            self.hourly_stats[arm].add(algo_timing)
+
+    def compact_samples(self, cutoff, batch_rows, archive):
+        # Nothing outlives the process, so archived samples are simply dropped
+        with self._lock:
+            finished = set(experiment_no for experiment_no, experiment in self.experiments.items()
+                           if experiment["end_date"] is not None)
+            compacted = []
+            kept = deque()
+            for sample in self.samples:
+                if len(compacted) < batch_rows and sample[0] in finished and sample[3] < cutoff:
+                    compacted.append(sample)
+                else:
+                    kept.append(sample)
+            self.samples = kept
+            self._roll_up(compacted)
+            return len(compacted)
+
+    def get_hourly_stats(self, experiment_no):
+        stats = {}
+        with self._lock:
+            for (arm_experiment_no, algo_version, hour), hourly in self.hourly_stats.items():
+                if arm_experiment_no == experiment_no:
+                    stats[(algo_version, hour)] = LatencyStats().merge(hourly)
+            for sample in self.samples:
+                if sample[0] == experiment_no:
+                    stats.setdefault((sample[1], to_hour(sample[3])), LatencyStats()).add(sample[2])
+        return stats
+
+    def get_experiment_stats(self, experiment_no, with_sketch=True):
+        arm_stats = {}
+        with self._lock:
+            for (arm_experiment_no, algo_version), stats in self.arm_stats.items():
+                if arm_experiment_no == experiment_no:
+                    # Hand out copies, the stored statistics keep changing
+                    copy = LatencyStats.from_totals(stats.count, stats.total, stats.total_sq, stats.minimum, stats.maximum)
+                    if with_sketch:
+                        copy.buckets = dict(stats.buckets)
+                    arm_stats[algo_version] = copy
+        return arm_stats
+
+    def acquire_lease(self, name, owner, seconds):
+        now = time.monotonic()
+        with self._lock:
+            holder = self.leases.get(name)
+            if holder is not None and holder[0] != owner and holder[1] >= now:
+                return False
+            self.leases[name] = (owner, now + seconds)
+            return True
+
+    def release_lease(self, name, owner):
+        with self._lock:
+            if self.leases.get(name, (None,))[0] == owner:
+                del self.leases[name]
+
+def make_store(backend):
+    if backend == 'mysql':
+        return MySQLStore()
+    elif backend == 'sqlite':
+        return SQLiteStore(sqlite_path)
+    elif backend == 'memory':
+        return MemoryStore()
+    else:
+        raise Exception("Unknown db_backend: {}".format(backend))
+
+store = make_store(db_backend)
+
+def add_hourly_sample_stats(cursor, samples):
+    '''
+    Add (experiment_no, algo_version, algo_timing, created_at) samples to the hourly latency statistics
+    '''
+    stats_rows, sketch_rows = group_sample_stats(samples, by_hour=True)
+    cursor.executemany(
+        "INSERT INTO {}.experimentHourlyStats"
+        " (experiment_no, algo_version, hour, samples, latency_sum, latency_sum_sq, latency_min, latency_max)"
+        " VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
+        " ON DUPLICATE KEY UPDATE samples = samples + VALUES(samples),"
+        " latency_sum = latency_sum + VALUES(latency_sum),"
+        " latency_sum_sq = latency_sum_sq + VALUES(latency_sum_sq),"
+        " latency_min = LEAST(COALESCE(latency_min, VALUES(latency_min)), VALUES(latency_min)),"
+        " latency_max = GREATEST(COALESCE(latency_max, VALUES(latency_max)), VALUES(latency_max))".format(db_name),
+        stats_rows)
+    cursor.executemany(
+        "INSERT INTO {}.experimentHourlySketch (experiment_no, algo_version, hour, bucket, samples) VALUES (%s, %s, %s, %s, %s)"
+        " ON DUPLICATE KEY UPDATE samples = samples + VALUES(samples)".format(db_name),
+        sketch_rows)
+
+def write_samples(samples):
+    '''
+    Write (experiment_no, algo_version, algo_timing, created_at) samples to the store
+    '''
+    with metrics.timer("sample_flush"):
+        store.write_samples(samples)
+
+class SampleWriter:
+    '''
+    Write-behind buffer for experiment samples.
+    Requests only queue their sample; a background thread writes them in batches
+    every batch_rows samples or flush_interval seconds, and once more on shutdown.
+    When the buffer is full, requests wait up to put_timeout seconds before the sample is dropped.
+    A batch that fails write_attempts times in a row is dropped.
+    '''
+    def __init__(self, write, batch_rows, flush_interval, buffer_size, put_timeout, write_attempts):
+        self.write = write
+        self.write_attempts = write_attempts
+        self.batch_rows = batch_rows
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self._buffer = queue.Queue(maxsize=buffer_size)
+        self._pending = []
+        self._pending_failures = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.stats = {"queued": 0, "written": 0, "flushes": 0, "waits": 0, "dropped": 0, "errors": 0}
+
+    def _count(self, stat, value=1):
+        with self._lock:
+            self.stats[stat] += value
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="sample-writer", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def try_add(self, sample):
+        '''
+        Queue a sample without waiting. Returns False if the buffer is full.
+        '''
+        if self._thread is None:
+            self.start()
+        try:
+            self._buffer.put_nowait(sample)
+        except queue.Full:
+            return False
+        self._count("queued")
+        if self._buffer.qsize() >= self.batch_rows:
+            self._wake.set()
+        return True
+
+    def add_many(self, samples):
+        '''
+        Queue samples from one request and wake the writer, so they go out in the same INSERT
+        '''
+        for sample in samples:
+            self.add(sample)
+        self._wake.set()
+
+    def add(self, sample):
+        with metrics.timer("sample_enqueue"):
+            self._add(sample)
+
+    def _add(self, sample):
+        if self.try_add(sample):
+            return
+        self._count("waits")
+        self._wake.set()
+        try:
+            self._buffer.put(sample, timeout=self.put_timeout)
+        except queue.Full:
+            self._count("dropped")
+            log(0, "Sample buffer is full, dropping sample")
+            return
+        self._count("queued")
+        if self._buffer.qsize() >= self.batch_rows:
+            self._wake.set()
+
+    def flush(self):
+        '''
+        Write everything buffered so far. A failed batch is kept and retried on the next flush,
+        up to write_attempts times.
+        '''
+        with self._flush_lock:
+            while True:
+                batch = self._pending
+                while len(batch) < self.batch_rows:
+                    try:
+                        batch.append(self._buffer.get_nowait())
+                    except queue.Empty:
+                        break
+                if not batch:
+                    return
+                try:
+                    self.write(batch)
+                except Exception as err:
+                    self._count("errors")
+                    self._pending_failures += 1
+                    if self._pending_failures < self.write_attempts:
+                        self._pending = batch
+                        log(0, "Failed writing {} samples: {}", len(batch), err)
+                        return
+                    # Give up on this batch, so the samples queued behind it can be written
+                    self._pending = []
+                    self._pending_failures = 0
+                    self._count("dropped", len(batch))
+                    log(0, "Dropping {} samples after {} failed writes: {}", len(batch), self.write_attempts, err)
+                    return
+                self._pending = []
+                self._pending_failures = 0
+                self._count("written", len(batch))
+                self._count("flushes")
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats["buffered"] = self._buffer.qsize() + len(self._pending)
+        return stats
+
+sample_writer = SampleWriter(write_samples, sample_batch_rows, sample_flush_interval,
+                             sample_buffer_size, sample_buffer_timeout, sample_write_attempts)
+metrics.register("sample_writer", sample_writer.get_stats)
+metrics.register("db_pool", db_pool.get_stats)
+
+def fetch_latest_algo_version(name):
     '''
-    Returns the latest semantic algo version if available
+    Returns the latest semantic version of an algorithm if available, straight from the Algorithmia API
     '''
     # Get all published versions
-    r = client.algo(algo_name).versions(published=True)
+    with metrics.timer("version_discovery"):
+        r = client.algo(name).versions(published=True)
     # Extract only versions
     all_versions = list(map(lambda x: semantic_version.Version(x['version_info']['semantic_version']), r.results))
     # Get the latest version
@@ -90,58 +1638,158 @@ def get_latest_algo_version():
     else:
         return None
 
-def get_db_stable_version():
+class VersionPoller:
     '''
-    Returns the semantic DB stable version
+    Keeps the latest published version of every target algorithm in memory.
+    The first read of an algorithm fetches it once; after that one background thread refreshes
+    all of them every interval seconds (plus jitter), so requests never call the management API.
+    '''
+    def __init__(self, fetch, interval, jitter):
+        self.fetch = fetch
+        self.interval = interval
+        self.jitter = jitter
+        self.latest_versions = {}
+        self.last_refresh = {}
+        self.errors = 0
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+        self._thread = None
+
+    def start(self, name):
+        with self._start_lock:
+            if name not in self.latest_versions:
+                self.refresh([name])
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="version-poller", daemon=True)
+                self._thread.start()
+
+    def refresh(self, names=None):
+        for name in list(self.latest_versions) if names is None else names:
+            try:
+                self.latest_versions[name] = self.fetch(name)
+                self.last_refresh[name] = time.time()
+            except Exception as err:
+                self.errors += 1
+                metrics.count("version_refresh_errors")
+                log(0, "Failed refreshing latest version of {}: {}", name, err)
+                self.latest_versions.setdefault(name, None)
+
+    def _run(self):
+        while not self._stop.wait(self.interval * (1 + random.uniform(0, self.jitter))):
+            self.refresh()
+
+    def stop(self):
+        self._stop.set()
+
+    def is_tracking(self, name):
+        return name in self.latest_versions
+
+    def latest(self, name):
+        if name not in self.latest_versions:
+            self.start(name)
+        return self.latest_versions[name]
+
+version_poller = VersionPoller(fetch_latest_algo_version, version_poll_interval, version_poll_jitter)
+
+def get_latest_algo_version():
+    '''
+    Returns the latest semantic version of the target algorithm if available, as last seen by the version poller
     '''
-    db = Database(creds=creds)
-    df = db.send_query("""SELECT * FROM ModelMonitoring.metaData WHERE setting = 'stable_version';""")
-    db.close()
-    db_stable_version = df.loc[0]['val']
-    if db_stable_version:
-        return semantic_version.Version(db_stable_version)
+    return version_poller.latest(current_state().name)
+
+def get_db_setting(setting):
+    '''
+    Returns the raw metaData value of a setting
+    '''
+    with metrics.timer("metadata_read"):
+        return store.get_setting(current_state().name, setting)
+
+def to_semantic_version(version):
+    '''
+    Converts a metaData version value into a semantic version
+    '''
+    if version:
+        return semantic_version.Version(version)
     else:
         return
 
+def get_db_schema_version():
+    '''
+    Returns the schema version recorded in metaData, 1 for databases created before it was recorded
+    '''
+    schema_version = store.get_schema_version()
+    if schema_version is None:
+        return 1
+    return int(schema_version)
+
+def get_db_stable_version():
+    '''
+    Returns the semantic DB stable version
+    '''
+    return current_state().settings_cache.get('stable_version', lambda: to_semantic_version(get_db_setting('stable_version')))
+
 def get_db_exp_version():
     '''
     Returns the semantic DB experiment version
     '''
-    db = Database(creds=creds)
-    df = db.send_query("""SELECT * FROM ModelMonitoring.metaData WHERE setting = 'experiment_version';""")
-    db.close()
-    db_exp_version = df.loc[0]['val']
-    if db_exp_version:
-        return semantic_version.Version(db_exp_version)
-    else:
-        return
+    return current_state().settings_cache.get('experiment_version', lambda: to_semantic_version(get_db_setting('experiment_version')))
+
+def get_experiment_stats(experiment_no, with_sketch=True):
+    '''
+    Returns the persisted LatencyStats of every version arm in an experiment.
+    Without the sketch only count, mean, variance and min/max are available.
+    '''
+    with metrics.timer("stats_read"):
+        return store.get_experiment_stats(experiment_no, with_sketch)
 
-def get_db_exp_data_count(experiment_no):
+def get_hourly_stats(experiment_no):
     '''
-    Count number of registered data points in DB
+    Returns {(algo_version, hour): LatencyStats} for an experiment. Compacted and raw samples
+    are combined, so the result doesn't change when compact_samples.py runs.
     '''
-    db = Database(creds=creds)
-    df = db.send_query("""SELECT * FROM ModelMonitoring.experimentData WHERE experiment_no = '{}';""".format(experiment_no))
-    db.close()
-    return len(df)
+    return store.get_hourly_stats(experiment_no)
+
+def compact_samples(retention_days=None, batch_rows=None, archive=None):
+    '''
+    Compact one batch of raw samples of finished experiments older than retention_days,
+    returns the number of compacted samples
+    '''
+    retention_days = sample_retention_days if retention_days is None else retention_days
+    cutoff = datetime.now() - timedelta(days=retention_days)
+    with metrics.timer("compaction"):
+        compacted = store.compact_samples(cutoff, batch_rows or compaction_batch_rows,
+                                          compaction_archive if archive is None else archive)
+    metrics.count("samples_compacted", compacted)
+    return compacted
 
 def get_exp_no():
     '''
     Get current running experiment id/number
     '''
-    db = Database(creds=creds)
-    df = db.send_query("""SELECT MAX(experiment_no) FROM ModelMonitoring.experiments;""")
-    experiment_no = int(df["MAX(experiment_no)"])
-    return experiment_no
+    return current_state().settings_cache.get('experiment_no', read_db_exp_no)
+
+def read_db_exp_no():
+    '''
+    Read the latest experiment id/number of the target algorithm from the DB
+    '''
+    with metrics.timer("metadata_read"):
+        return store.get_latest_experiment_no(current_state().name)
+
+def get_version_status(version):
+    '''
+    Returns the status of the latest deployment of a version: 'success', 'fail', 'experiment' or None
+    '''
+    return current_state().settings_cache.get('version_status:{}'.format(version), lambda: read_db_version_status(version))
+
+def read_db_version_status(version):
+    with metrics.timer("metadata_read"):
+        return store.get_version_status(current_state().name, str(version))
 
 def is_experiment_running():
     '''
     Checks if an experiment is already running
     '''
-    db = Database(creds=creds)
-    df = db.send_query("""SELECT * FROM ModelMonitoring.metaData WHERE setting = 'experiment_running';""")
-    db.close()
-    exp_running = db_stable_version = df.loc[0]['val']
+    exp_running = current_state().settings_cache.get('experiment_running', lambda: get_db_setting('experiment_running'))
     if exp_running == "True":
         return True
     elif exp_running == "False":
@@ -154,10 +1802,7 @@ def get_test_version():
     Split all incoming requests according to (experiment_split)
         and return the corresponding semantic version
     '''
-    choice = random.random()
-    sign = ">=" if choice >= experiment_split else "<"
-    print("Picking random split: {:10.3f}{}{}".format(choice, sign, experiment_split))
-    if choice >= experiment_split:
+    if pick_test_type() == "experiment":
         # Get the experimental version
         response = ("experiment", get_db_exp_version())
     else:
@@ -165,252 +1810,933 @@ def get_test_version():
         response = ("stable", get_db_stable_version())
     return response
 
+def pick_test_type():
+    '''
+    Randomly pick "experiment" or "stable" according to (experiment_split)
+    '''
+    choice = random.random()
+    sign = ">=" if choice >= experiment_split else "<"
+    log(2, "Picking random split: {:10.3f}{}{}", choice, sign, experiment_split)
+    return "experiment" if choice >= experiment_split else "stable"
+
 def register_test_data(algo_exp_data, test_version):
     '''
     Register the test/experimental call
     '''
-    today_date = date.today()
-    experiment_no = get_exp_no()
-    experiment_data = pd.DataFrame([[json.dumps(algo_exp_data), today_date, str(test_version), experiment_no]],
-                                   columns=["data", "date", "algo_version", "experiment_no"])
-    db = Database(creds=creds)
-    db.send_data(experiment_data, 'experimentData', mode='insert')
-    db.close()
+    sample_writer.add(new_sample(get_exp_no(), test_version, algo_exp_data["algo_timing"]))
+
+def new_sample(experiment_no, test_version, algo_timing):
+    '''
+    Build a sample row as written by write_samples()
+    '''
+    return (experiment_no, str(test_version), algo_timing, datetime.now())
+
+def confidence_radius(spread, samples, error_rate):
+    '''
+    Half-width of an always-valid (asymptotic) confidence sequence for a mean of samples
+    with standard deviation spread. Unlike a fixed-sample confidence interval it stays
+    valid however often it is checked. It is tightest around sequential_min_samples.
+    '''
+    log_term = -2 * math.log(error_rate)
+    rho_sq = (log_term + math.log(log_term + 1)) / sequential_min_samples
+    scaled = samples * rho_sq + 1
+    return spread * math.sqrt(2 * scaled / (samples * samples * rho_sq) * math.log(math.sqrt(scaled) / error_rate))
+
+def sequential_decision(stable_stats, experiment_stats):
+    '''
+    Sequential test on the mean latency difference (experiment - stable).
+    Returns "fail" once the experiment version is clearly slower than stable + sequential_margin
+    (or clearly slower than experiment_threshold on average), "promote" once it is clearly not,
+    and None while more samples are needed.
+    '''
+    if stable_stats is None or experiment_stats is None:
+        return None
+    samples = min(stable_stats.count, experiment_stats.count)
+    if samples < sequential_min_samples:
+        return None
+    if is_clearly_slower(stable_stats, experiment_stats):
+        return "fail"
+    difference, spread, experiment_spread = latency_difference(stable_stats, experiment_stats)
+    if (difference + confidence_radius(spread, samples, sequential_beta) <= sequential_margin and
+            experiment_stats.mean + confidence_radius(experiment_spread, experiment_stats.count, sequential_beta) <= experiment_threshold):
+        return "promote"
+    return None
+
+def latency_difference(stable_stats, experiment_stats):
+    '''
+    Returns the mean latency difference (experiment - stable), its standard deviation scaled to
+    the smaller arm's sample count, and the standard deviation of the experiment version
+    '''
+    samples = min(stable_stats.count, experiment_stats.count)
+    spread = math.sqrt(experiment_stats.variance * samples / experiment_stats.count +
+                       stable_stats.variance * samples / stable_stats.count)
+    return experiment_stats.mean - stable_stats.mean, spread, math.sqrt(experiment_stats.variance)
+
+def is_clearly_slower(stable_stats, experiment_stats):
+    '''
+    True if the experiment version is clearly slower than stable + sequential_margin,
+    or clearly slower than experiment_threshold on average, with error rate sequential_alpha
+    '''
+    samples = min(stable_stats.count, experiment_stats.count)
+    difference, spread, experiment_spread = latency_difference(stable_stats, experiment_stats)
+    if difference - confidence_radius(spread, samples, sequential_alpha) > sequential_margin:
+        return True
+    return experiment_stats.mean - confidence_radius(experiment_spread, experiment_stats.count, sequential_alpha) > experiment_threshold
+
+def is_slowdown_confirmed(experiment_no):
+    '''
+    Checks whether the samples of the running experiment confirm that the experiment version is
+    clearly slower, after its circuit breaker opened on slow calls. The confidence sequence is valid
+    for any number of samples, so this doesn't wait for sequential_min_samples.
+    '''
+    sample_writer.flush()
+    arm_stats = get_experiment_stats(experiment_no, with_sketch=False)
+    stable_stats = arm_stats.get(str(get_db_stable_version()))
+    experiment_stats = arm_stats.get(str(get_db_exp_version()))
+    if stable_stats is None or experiment_stats is None:
+        return False
+    if min(stable_stats.count, experiment_stats.count) < breaker_min_calls:
+        return False
+    return is_clearly_slower(stable_stats, experiment_stats)
 
-def resolve_experiment(experiment_no):
+def is_experiment_decided(experiment_no):
     '''
-    Resolve the running experiment
+    Checks whether the running experiment has enough samples to be resolved
+    '''
+    # Percentile metrics need the sketch, the mean doesn't
+    arm_stats = get_experiment_stats(experiment_no, with_sketch=experiment_metric != 'mean')
+    return is_experiment_ready(arm_stats, get_db_stable_version(), get_db_exp_version())
+
+def is_experiment_ready(arm_stats, stable_version, experiment_version):
+    '''
+    Checks per-arm LatencyStats against experiment_count and the sequential test
+    '''
+    return experiment_outcome(arm_stats, stable_version, experiment_version) is not None
+
+def experiment_outcome(arm_stats, stable_version, experiment_version):
+    '''
+    Returns what resolve_experiment() does with these per-arm LatencyStats: "promote", "fail",
+    or None while more samples are needed. The sequential test can decide before experiment_count
+    samples, but the experiment version is only promoted if its experiment_metric is within experiment_threshold.
+    '''
+    stable_stats = arm_stats.get(str(stable_version))
+    experiment_stats = arm_stats.get(str(experiment_version))
+    db_exp_count = sum(stats.count for stats in arm_stats.values())
+    log(2, "Number of test (stable + experiment) calls made: {}", db_exp_count)
+    # If no data was collected for the experimental model, fail the deployment
+    if experiment_stats is None or experiment_stats.count == 0:
+        return "fail" if db_exp_count >= experiment_count else None
+    experiment_runtime = experiment_stats.metric(experiment_metric)
+    decision = sequential_decision(stable_stats, experiment_stats) if sequential_testing else None
+    if decision == "fail":
+        return "fail"
+    if decision == "promote" and experiment_runtime <= experiment_threshold:
+        return "promote"
+    if db_exp_count < experiment_count:
+        return None
+    # Otherwise, assess if the runtime (experiment_metric) is not worse than experiment_threshold
+    return "fail" if experiment_runtime > experiment_threshold else "promote"
+
+def resolve_experiment(experiment_no, regressed=False):
+    '''
+    Resolve the running experiment, regressed fails the experiment version whatever the samples say
     '''
     # See if the experiment version can be promoted
     # Promote or fail experiment version
     # Update experiment in experiments table
     # Update version info in versions table
     # Update metadata with new stable version if promoted
+    # Make sure every sample buffered by this process is in the DB first
+    sample_writer.flush()
     stable_version = str(get_db_stable_version())
     experiment_version = str(get_db_exp_version())
-    # Collect all experiment data
-    db = Database(creds=creds)
-    df_stable_stable_data = db.send_query(
-        """SELECT * FROM ModelMonitoring.experimentData WHERE algo_version = '{}' AND experiment_no = '{}';""".format(
-            stable_version, experiment_no
-        )
-    )
-    df_stable_experiment_data = db.send_query(
-        """SELECT * FROM ModelMonitoring.experimentData WHERE algo_version = '{}' AND experiment_no = '{}';""".format(
-            experiment_version, experiment_no
-        )
-    )
-    stable_avg_runtime = None
-    experiment_avg_runtime = None
+    # Collect the latency statistics of both versions
+    arm_stats = get_experiment_stats(experiment_no)
+    stable_stats = arm_stats.get(stable_version)
+    experiment_stats = arm_stats.get(experiment_version)
     # Let's still record the stable statistics just in case we use them.
-    if not df_stable_stable_data.empty:
-        stable_all_times = list(map(lambda x: json.loads(x)["algo_timing"], df_stable_stable_data["data"]))
-        stable_avg_runtime = sum(stable_all_times)/len(stable_all_times)
-    else:
-        stable_all_times = -1
-        stable_avg_runtime = -1
-    if not df_stable_experiment_data.empty:
-        experiment_all_times = list(map(lambda x: json.loads(x)["algo_timing"], df_stable_stable_data["data"]))
-        experiment_avg_runtime = sum(experiment_all_times)/len(experiment_all_times)
-    else:
-        experiment_all_times = -1
-        experiment_avg_runtime = -1
-
-    # If no data was collected for the experimental model, abort deployment, and fail the deployment
-    if experiment_avg_runtime < 0:
+    if stable_stats is not None:
+        log(1, "Runtime statistics for stable model: {}", stable_stats.summary())
+    # The circuit breaker opened on failed calls, or on slow calls that the samples confirm
+    if regressed:
+        log(1, "Circuit breaker opened for experiment version, failing it")
+        fail_experiment_version(experiment_version, experiment_no)
+        return
+    if experiment_stats is not None and experiment_stats.count:
+        log(1, "Runtime statistics for experiment model: {}", experiment_stats.summary())
+        log(1, "Runtime ({}) for experiment model: {}", experiment_metric, experiment_stats.metric(experiment_metric))
+    outcome = experiment_outcome(arm_stats, stable_version, experiment_version)
+    if outcome is None:
+        log(1, "Not enough samples to resolve the experiment yet")
+        return
+    if sum(stats.count for stats in arm_stats.values()) < experiment_count:
+        log(1, "Experiment version is clearly {}, ending experiment early",
+            "slower" if outcome == "fail" else "not slower")
+    if outcome == "fail":
         fail_experiment_version(experiment_version, experiment_no)
     else:
-        # Otherwise, assess if the average runtime is not worse than experiment_threshold
-        print("Average runtime for experiment model: {}".format(experiment_avg_runtime))
-        if experiment_avg_runtime > experiment_threshold:
-            fail_experiment_version(experiment_version, experiment_no)
-        else:
-            promote_experiment_version(experiment_version, experiment_no)
+        promote_experiment_version(experiment_version, experiment_no)
 
 
 def promote_experiment_version(version_update, experiment_number):
-    print("Promoting version {}...".format(version_update))
-    db = Database(creds=creds)
+    log(1, "Promoting version {}...", version_update)
     today_date = date.today()
-
-    experiment_running = pd.DataFrame([[1, "experiment_running", "False"]], columns=["id", "setting", "val"])
-    stable_version = pd.DataFrame([[3, "stable_version", version_update]], columns=["id", "setting", "val"])
-    experiment_version = pd.DataFrame([[4, "experiment_version", None]], columns=["id", "setting", "val"])
-
-    db.send_data(experiment_running, 'metaData', mode='update')
-    db.send_data(stable_version, 'metaData', mode='update')
-    db.send_data(experiment_version, 'metaData', mode='update')
-
-    experiment_itself = pd.DataFrame([[experiment_number, today_date, True]], columns=["experiment_no", "end_date", "promoted"])
-    db.send_data(experiment_itself, 'experiments', mode='update')
-
-    version_id = int(db.send_query("""SELECT * FROM ModelMonitoring.versions WHERE version = '{}';""".format(version_update))['ver_no'].iloc[-1])
-
-    version = pd.DataFrame([[version_id, version_update, "success"]], columns=["ver_no","version", "status"])
-    db.send_data(version, 'versions', mode='update')
-    print("Version {} has been promoted!".format(version_update))
+    state = current_state()
+    store.set_settings(state.name, {"experiment_running": "False", "stable_version": version_update, "experiment_version": None})
+    store.end_experiment(experiment_number, today_date, True)
+    store.set_version_status(state.name, version_update, "success")
+    state.settings_cache.invalidate()
+    state.breaker.reset()
+    metrics.count("promotions")
+    log(1, "Version {} has been promoted!", version_update)
 
 def fail_experiment_version(version_update, experiment_number):
-    print("Failing version {}...".format(version_update))
-    db = Database(creds=creds)
+    log(1, "Failing version {}...", version_update)
     today_date = date.today()
-
-    experiment_running = pd.DataFrame([[1, "experiment_running", "False"]], columns=["id", "setting", "val"])
-    experiment_version = pd.DataFrame([[4, "experiment_version", None]], columns=["id", "setting", "val"])
-
-    db.send_data(experiment_running, 'metaData', mode='update')
-    db.send_data(experiment_version, 'metaData', mode='update')
-
-    experiment_itself = pd.DataFrame([[experiment_number, today_date, False]], columns=["experiment_no", "end_date", "promoted"])
-    db.send_data(experiment_itself, 'experiments', mode='update')
-
-    version_id = int(db.send_query("""SELECT * FROM ModelMonitoring.versions WHERE version = '{}';""".format(version_update))['ver_no'].iloc[-1])
-
-    version = pd.DataFrame([[version_id, version_update, "fail"]], columns=["ver_no","version", "status"])
-    db.send_data(version, 'versions', mode='update')
-    print("Version {} has been failed!".format(version_update))
+    state = current_state()
+    store.set_settings(state.name, {"experiment_running": "False", "experiment_version": None})
+    store.end_experiment(experiment_number, today_date, False)
+    store.set_version_status(state.name, version_update, "fail")
+    state.settings_cache.invalidate()
+    state.breaker.reset()
+    metrics.count("failures")
+    log(1, "Version {} has been failed!", version_update)
 
 def create_database(cursor):
     try:
         cursor.execute(
             "CREATE DATABASE {} DEFAULT CHARACTER SET 'utf8'".format(db_name))
     except mysql.connector.Error as err:
-        print("Failed creating database: {}".format(err))
-
-def get_db_obj():
-    '''
-    Get the DB cursor object.
-    '''
-    cnx = mysql.connector.connect(user=db_username, password=db_password, host=db_host)
-    cursor = cnx.cursor(buffered=True)
-    return cursor, cnx
+        log(0, "Failed creating database: {}", err)
 
 def init_database():
     '''
-    Create all the tables we're going to use, and the meta data if it doesn't exist.
+    Create all the tables we're going to use, once per process.
     '''
     global check_db_init
-    curr, conn = get_db_obj()
-    # First, create database if it doesn't exist
-    try:
-        curr.execute("USE {}".format(db_name))
-    except mysql.connector.Error as err:
-        print("Database {} does not exists.".format(db_name))
-        if err.errno == errorcode.ER_BAD_DB_ERROR:
-            create_database(curr)
-            print("Database {} created successfully.".format(db_name))
-            conn.database = db_name
-        else:
-            print(err)
-        # Second, create all tables that are going to be used
-        for table_name in db_tables:
-            table_description = db_tables[table_name]
-            try:
-                print("Creating table {}: ".format(table_name), end='')
-                curr.execute(table_description)
-            except mysql.connector.Error as err:
-                if err.errno == errorcode.ER_TABLE_EXISTS_ERROR:
-                    print("already exists.")
-                else:
-                    print(err.msg)
-            else:
-                print("OK")
-        print("Inserting metadata")
-        experiment_running = pd.DataFrame([[1, "experiment_running", "False"]], columns=["id", "setting", "val"])
-        experiment_count = pd.DataFrame([[2, "experiment_count", None]], columns=["id", "setting", "val"])
-        stable_version = pd.DataFrame([[3, "stable_version", None]], columns=["id", "setting", "val"])
-        experiment_version = pd.DataFrame([[4, "experiment_version", None]], columns=["id", "setting", "val"])
-        db = Database(creds=creds)
-        db.send_data(experiment_running, 'metaData', mode='insert')
-        db.send_data(experiment_count, 'metaData', mode='insert')
-        db.send_data(stable_version, 'metaData', mode='insert')
-        db.send_data(experiment_version, 'metaData', mode='insert')
-        db.close()
-        print("Metadata created successfully")
+    if store.init_store():
+        store.set_settings('', {"schema_version": str(db_schema_version)})
+    else:
+        schema_version = get_db_schema_version()
+        if schema_version < db_schema_version:
+            raise Exception("Database {} uses schema version {}, run migrate_schema.py to upgrade it to version {}".format(
+                db_name, schema_version, db_schema_version))
     check_db_init = True
     return
 
-def call_algorithm(input):
+def init_algorithm():
+    '''
+    Create the meta data of the target algorithm if it doesn't exist, once per process and algorithm
+    '''
+    if not check_db_init:
+        init_database()
+    state = current_state()
+    log(1, "Inserting metadata for {}", state.name)
+    # Other processes may be setting up the same algorithm, existing settings are kept
+    store.init_settings(state.name, {"experiment_running": "False", "experiment_count": None, "stable_version": None,
+                                     "experiment_version": None})
+    state.db_init = True
+
+def set_first_stable_version(latest_algo_version):
+    '''
+    Record the first published version as the stable version
+    '''
+    today_date = date.today()
+    state = current_state()
+    store.set_settings(state.name, {"stable_version": str(latest_algo_version)})
+    store.add_experiment(state.name, "None", str(latest_algo_version), today_date, today_date, True)
+    store.add_version(state.name, str(latest_algo_version), "success", today_date)
+    state.settings_cache.invalidate()
+    log(1, "First stable version of {} set to: {}", state.name, latest_algo_version)
+
+def start_experiment(db_stable_version, latest_algo_version):
+    '''
+    Start a new experiment of the latest published version against the stable version
+    '''
+    metrics.count("experiments_started")
+    state = current_state()
+    log(1, "Starting new experiment for {}", state.name)
+    today_date = date.today()
+    store.add_version(state.name, str(latest_algo_version), "experiment", today_date)
+    store.add_experiment(state.name, str(db_stable_version), str(latest_algo_version), today_date, None, None)
+    store.set_settings(state.name, {"experiment_running": "True", "experiment_version": str(latest_algo_version)})
+    state.settings_cache.invalidate()
+    state.breaker.reset()
+
+# Threads of this process set up the first stable version or an experiment one at a time
+setup_lock = threading.Lock()
+
+def get_routing():
+    '''
+    Returns (stable_version, experiment_version) for the next request(s), where experiment_version
+    is None if there isn't a new deployed version. Sets the first stable version and starts a new
+    experiment when needed.
+    '''
     # If there isn't a "latest-stable-version" yet, update it to the latest algorithm version.
     db_stable_version = get_db_stable_version()
-    print("DB stable version is: {}".format(db_stable_version))
+    log(2, "DB stable version is: {}", db_stable_version)
     if not db_stable_version:
-        latest_algo_version = get_latest_algo_version()
-        if not latest_algo_version:
-            raise Exception("There isn't a published version of the model {} yet.".format(algo_name))
-        latest_stable_version = pd.DataFrame([[3, "stable_version", str(latest_algo_version)]],
-                                             columns=["id", "setting", "val"])
-        today_date = date.today()
-        exp_start_date = today_date
-        exp_end_date = today_date
-        initial_experiment = pd.DataFrame([["None", str(latest_algo_version), exp_start_date, exp_end_date, True]],
-                                          columns=["prev_ver", "next_ver", "start_date", "end_date", "promoted"])
-        init_version = pd.DataFrame([[str(latest_algo_version), "success", today_date]],
-                                    columns=["version", "status", "date"])
-        db = Database(creds=creds)
-        db.send_data(latest_stable_version, 'metaData', mode='update')
-        db.send_data(initial_experiment, 'experiments', mode='insert')
-        db.send_data(init_version, 'versions', mode='insert')
-        db.close()
-        print("First stable version set to: {}".format(latest_algo_version))
+        with setup_lock:
+            if not get_db_stable_version():
+                latest_algo_version = get_latest_algo_version()
+                if not latest_algo_version:
+                    raise Exception("There isn't a published version of the model {} yet.".format(current_state().name))
+                set_first_stable_version(latest_algo_version)
     # Get latest published version from Algorithmia
     latest_algo_version = get_latest_algo_version()
     # Get stable version from DB
     db_stable_version = get_db_stable_version()
     # If there isn't a new deployed version, just called the DB stable version
-    if not latest_algo_version > db_stable_version:
-        print("Calling the stable version: {}".format(latest_algo_version))
-        return client.algo("{}/{}".format(algo_name, str(latest_algo_version))).pipe(input)
+    if latest_algo_version is None or not latest_algo_version > db_stable_version:
+        return db_stable_version, None
+    log(2, "New deployed version has been found: {}", latest_algo_version)
+    # Create a new experiment if it isn't already running
+    if not is_experiment_running():
+        # A version that already failed its experiment keeps getting the stable traffic, until a newer one is published
+        if get_version_status(latest_algo_version) == "fail":
+            log(2, "Version {} has failed its experiment, calling the stable version", latest_algo_version)
+            return db_stable_version, None
+        with setup_lock:
+            # Another thread may have started the experiment while this one waited, or the resolver
+            # may have ended it, so the settings are read again from the DB
+            current_state().settings_cache.invalidate()
+            db_stable_version = get_db_stable_version()
+            if not latest_algo_version > db_stable_version:
+                return db_stable_version, None
+            if not is_experiment_running():
+                # Only a version that was never deployed gets an experiment, not one already promoted or failed
+                if get_version_status(latest_algo_version) is not None:
+                    return db_stable_version, None
+                start_experiment(db_stable_version, latest_algo_version)
     else:
-        print("New deployed version has been found: {}".format(latest_algo_version))
-        # Create a new experiment if it isn't already running
-        if not is_experiment_running():
-            print("Starting new experiment")
-            # Start new experiment
-            today_date = date.today()
-            new_version = pd.DataFrame([[str(latest_algo_version), "experiment", today_date]],
-                                       columns=["version", "status", "date"])
-            new_experiment = pd.DataFrame([[str(db_stable_version), str(latest_algo_version), today_date, None, None]],
-                                              columns=["prev_ver", "next_ver", "start_date", "end_date", "promoted"])
-            experiment_running = pd.DataFrame([[1, "experiment_running", "True"]],
-                                              columns=["id", "setting", "val"])
-            experiment_version = pd.DataFrame([[4, "experiment_version", str(latest_algo_version)]],
-                                              columns=["id", "setting", "val"])
-            db = Database(creds=creds)
-            db.send_data(new_version, 'versions', mode='insert')
-            db.send_data(new_experiment, 'experiments', mode='insert')
-            db.send_data(experiment_running, 'metaData', mode='update')
-            db.send_data(experiment_version, 'metaData', mode='update')
-            db.close()
+        log(2, "Continuing existing experiment")
+    return db_stable_version, get_db_exp_version()
+
+lease_owner = "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+def acquire_lease(name, owner, seconds):
+    '''
+    Take the lease called name for seconds, or extend it if owner already holds it.
+    Returns False while another owner holds an unexpired lease.
+    '''
+    return store.acquire_lease(name, owner, seconds)
+
+def release_lease(name, owner):
+    store.release_lease(name, owner)
+
+class ExperimentResolver:
+    '''
+    Resolves experiments off the request path. Requests only call notify(); a background
+    thread then checks, at most every check_interval seconds, whether the running experiments
+    of the notifying algorithms can be ended. An experiment is resolved while holding the DB
+    lease "resolve:<experiment_no>", so exactly one process resolves it even when several of
+    them see it is ready.
+    '''
+    def __init__(self, check_interval, lease_seconds):
+        self.check_interval = check_interval
+        self.lease_seconds = lease_seconds
+        self.stats = {"notifications": 0, "checks": 0, "resolved": 0, "lease_busy": 0, "errors": 0}
+        self._pending = set()
+        self._regressed = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._start_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="experiment-resolver", daemon=True)
+                self._thread.start()
+
+    def notify(self):
+        '''
+        Signal that new samples of the target algorithm were recorded, returns right away
+        '''
+        self.stats["notifications"] += 1
+        if not resolve_on_requests:
+            return
+        with self._lock:
+            self._pending.add(current_state().name)
+        if self._thread is None:
+            self.start()
+        self._wake.set()
+
+    def notify_regressed(self, name, reason):
+        '''
+        Signal that the circuit breaker of the algorithm name opened. With reason "errors" its experiment
+        version gets failed, with "slow" only once the samples confirm it is clearly slower.
+        This happens even without resolve_on_requests, because other processes can't see the breaker.
+        '''
+        with self._lock:
+            self._pending.add(name)
+            # A failing version is failed even if it was also slow
+            if self._regressed.get(name) != "errors":
+                self._regressed[name] = reason
+        if self._thread is None:
+            self.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            with self._lock:
+                names, self._pending = self._pending, set()
+                regressed, self._regressed = self._regressed, {}
+            for name in names:
+                with targeting(name), metrics.timer("resolution_check"):
+                    self.check(regressed.get(name))
+            # Signals that arrive meanwhile are coalesced into the next check
+            time.sleep(self.check_interval)
+
+    def check(self, regressed=None):
+        '''
+        Resolve the running experiment of the target algorithm if it can be ended, or fail its version
+        if the circuit breaker is still open for regressed ("errors", or "slow" confirmed by the samples).
+        Returns True if this process resolved it.
+        '''
+        self.stats["checks"] += 1
+        try:
+            if not is_experiment_running():
+                return False
+            experiment_no = get_exp_no()
+            # The breaker is reset when an experiment starts, so a closed one belongs to a newer experiment
+            if not current_state().breaker.is_open():
+                regressed = None
+            if regressed == "slow" and not is_slowdown_confirmed(experiment_no):
+                log(1, "Experiment {} isn't clearly slower yet, keeping it running", experiment_no)
+                regressed = None
+            if regressed is None and not is_experiment_decided(experiment_no):
+                return False
+            lease = "resolve:{}".format(experiment_no)
+            if not acquire_lease(lease, lease_owner, self.lease_seconds):
+                self.stats["lease_busy"] += 1
+                log(1, "Experiment {} is being resolved by another process", experiment_no)
+                return False
+            try:
+                # Another process may have resolved the experiment before the lease was free
+                current_state().settings_cache.invalidate()
+                if not is_experiment_running() or get_exp_no() != experiment_no:
+                    return False
+                log(1, "Resolving experiment {} of {}", experiment_no, current_state().name)
+                with metrics.timer("resolution"):
+                    resolve_experiment(experiment_no, regressed is not None)
+                self.stats["resolved"] += 1
+                return True
+            finally:
+                release_lease(lease, lease_owner)
+        except Exception as err:
+            self.stats["errors"] += 1
+            log(0, "Failed resolving experiment: {}", err)
+            return False
+
+experiment_resolver = ExperimentResolver(resolve_check_interval, resolve_lease_seconds)
+metrics.register("experiment_resolver", lambda: dict(experiment_resolver.stats))
+
+def check_experiment():
+    '''
+    After calls are made, signal the experiment resolver to check if the experiment can be ended
+    '''
+    experiment_resolver.notify()
+
+class CircuitBreaker:
+    '''
+    Tracks the outcome of recent experiment calls. It opens when too many of them failed or
+    exceeded the hedge budget, and requests are routed to the stable version while it is open.
+    After the cooldown a single trial call is let through: if it succeeds the breaker closes,
+    otherwise it stays open for another cooldown. on_open(reason) is called whenever the breaker
+    opens, with reason "errors" if too many calls failed and "slow" if too many were slow.
+    '''
+    def __init__(self, window, min_calls, error_rate, slow_rate, cooldown, on_open=None):
+        self.on_open = on_open
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.cooldown = cooldown
+        self.outcomes = deque(maxlen=window)
+        self.opened_at = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if not self.trial_running and time.monotonic() - self.opened_at >= self.cooldown:
+                self.trial_running = True
+                return True
+            return False
+
+    def record(self, failed, slow):
+        reason = self._record(failed, slow)
+        if reason is not None and self.on_open is not None:
+            self.on_open(reason)
+
+    def _record(self, failed, slow):
+        '''
+        Returns why the breaker opened, None if it didn't
+        '''
+        with self._lock:
+            if self.trial_running:
+                self.trial_running = False
+                if failed or slow:
+                    self.opened_at = time.monotonic()
+                    return "errors" if failed else "slow"
+                self.opened_at = None
+                self.outcomes.clear()
+                return None
+            if self.opened_at is not None:
+                return None
+            self.outcomes.append((failed, slow))
+            if len(self.outcomes) < self.min_calls:
+                return None
+            errors = sum(1 for failed, _ in self.outcomes if failed)
+            slow_calls = sum(1 for _, slow in self.outcomes if slow)
+            if errors >= self.error_rate * len(self.outcomes) or slow_calls >= self.slow_rate * len(self.outcomes):
+                log(1, "Opening circuit breaker: {} failed and {} slow out of the last {} experiment calls",
+                    errors, slow_calls, len(self.outcomes))
+                metrics.count("breaker_opened")
+                self.opened_at = time.monotonic()
+                return "errors" if errors >= self.error_rate * len(self.outcomes) else "slow"
+            return None
+
+    def is_open(self):
+        return self.opened_at is not None
+
+    def reset(self):
+        with self._lock:
+            self.outcomes.clear()
+            self.opened_at = None
+            self.trial_running = False
+
+class AlgorithmState:
+    '''
+    Routing state of one target algorithm, created on its first request: the cached metaData
+    settings and the circuit breaker of its experiment version. Everything else, the DB pool,
+    sample buffer, version poller, resolver and executors, is shared by all algorithms.
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.settings_cache = SettingsCache(settings_cache_ttl)
+        # An open breaker means the experiment version may have regressed, the resolver checks it
+        self.breaker = CircuitBreaker(breaker_window, breaker_min_calls, breaker_error_rate,
+                                      breaker_slow_rate, breaker_cooldown,
+                                      on_open=lambda reason: experiment_resolver.notify_regressed(name, reason))
+        self.db_init = False
+
+algorithm_states = {}
+algorithm_states_lock = threading.Lock()
+target_algorithm = contextvars.ContextVar("target_algorithm", default=None)
+
+def get_algorithm_state(name):
+    state = algorithm_states.get(name)
+    if state is None:
+        with algorithm_states_lock:
+            state = algorithm_states.setdefault(name, AlgorithmState(name))
+    return state
+
+def current_state():
+    '''
+    Returns the AlgorithmState of the algorithm the current request targets, algo_name by default
+    '''
+    return get_algorithm_state(target_algorithm.get() or algo_name)
+
+@contextmanager
+def targeting(name):
+    '''
+    Route everything in this block (and in threads started with submit()) to the algorithm name
+    '''
+    token = target_algorithm.set(name)
+    try:
+        yield get_algorithm_state(name)
+    finally:
+        target_algorithm.reset(token)
+
+def submit(executor, fn, *args):
+    '''
+    executor.submit() in the caller's context, so fn targets the same algorithm
+    '''
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+def parse_target(input):
+    '''
+    Split a request into (algorithm, input). {"algorithm": name, "input": ...} and
+    {"algorithm": name, "batch": [...]} target name, which must be in algo_names;
+    any other input targets algo_name.
+    '''
+    if isinstance(input, dict) and len(input) == 2 and "algorithm" in input and ("input" in input or "batch" in input):
+        name = input["algorithm"]
+        if name not in algo_names:
+            raise Exception("The model {} isn't monitored by this orchestrator.".format(name))
+        return name, input["input"] if "input" in input else {"batch": input["batch"]}
+    return algo_name, input
+
+experiment_executor = ThreadPoolExecutor(max_workers=hedge_workers, thread_name_prefix="experiment-call")
+hedge_executor = ThreadPoolExecutor(max_workers=hedge_workers, thread_name_prefix="hedge-call")
+
+def read_stable_p95():
+    '''
+    Returns the p95 latency of the stable version in the running experiment,
+    or None before it has sequential_min_samples samples
+    '''
+    stable_stats = get_experiment_stats(get_exp_no()).get(str(get_db_stable_version()))
+    if stable_stats is None or stable_stats.count < sequential_min_samples:
+        return None
+    return stable_stats.quantile(0.95)
+
+def get_hedge_budget():
+    '''
+    Seconds to wait for the experiment version before also calling the stable version
+    '''
+    if hedge_budget is not None:
+        return hedge_budget
+    settings_cache = current_state().settings_cache
+    hit, budget, generation = settings_cache.lookup('hedge_budget')
+    if not hit:
+        metrics.count("settings_cache_misses")
+        budget = read_stable_p95()
+        # A p95 of a few samples would make healthy calls look slow, so experiment_threshold is used
+        # until the stable version has enough samples. It's only cached until the next sample flush.
+        settings_cache.store('hedge_budget', budget, generation, None if budget is not None else sample_flush_interval)
+    return experiment_threshold if budget is None else budget
+
+class CachedResponse:
+    '''
+    Stands in for an AlgoResponse served from the response cache
+    '''
+    def __init__(self, result):
+        self.result = result
+        self.metadata = None
+
+class ResponseCache:
+    '''
+    LRU cache of algorithm results keyed by (algorithm, version, hash of the canonical input).
+    Entries expire after ttl seconds, and the least recently used ones are evicted once
+    there are more than max_entries or their approximate size exceeds max_bytes.
+    A new version never sees results of an old one, because the version is part of the key.
+    '''
+    def __init__(self, max_entries, ttl, max_bytes):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def key(self, version, input):
+        '''
+        Returns the cache key of an input, None if the cache is off or the input can't be hashed
+        '''
+        if not response_cache_enabled:
+            return None
+        if isinstance(input, bytes):
+            canonical = b"b" + input
+        elif isinstance(input, str):
+            canonical = b"s" + input.encode("utf-8")
         else:
-            print("Continuing existing experiment")
+            try:
+                canonical = b"j" + json.dumps(input, sort_keys=True, separators=(",", ":")).encode("utf-8")
+            except (TypeError, ValueError):
+                return None
+        return current_state().name, str(version), hashlib.sha256(canonical).hexdigest()
+
+    def get(self, key):
+        '''
+        Returns (hit, result)
+        '''
+        if key is None:
+            return False, None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[2] >= self.ttl:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.stats["misses"] += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return True, entry[0]
+
+    def put(self, key, result):
+        if key is None:
+            return
+        size = result_size(result)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (result, size, time.monotonic())
+            self.size += size
+            self.stats["stores"] += 1
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.stats["evictions"] += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.size -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self.size
+        return stats
+
+def result_size(result):
+    '''
+    Approximate memory used by a cached result
+    '''
+    if isinstance(result, (bytes, str)):
+        return len(result) + 100
+    try:
+        return len(json.dumps(result)) + 100
+    except (TypeError, ValueError):
+        return sys.getsizeof(result) + 100
+
+response_cache = ResponseCache(response_cache_entries, response_cache_ttl, response_cache_max_bytes)
+metrics.register("response_cache", response_cache.get_stats)
+
+def cached_pipe(version, input):
+    '''
+    Call a version of the target algorithm through the response cache.
+    Returns (algo_response, algo_timing), where algo_timing is None for a cached response,
+    so cache hits are never recorded as experiment samples.
+    '''
+    key = response_cache.key(version, input)
+    hit, result = response_cache.get(key)
+    if hit:
+        return CachedResponse(result), None
+    algo_response, algo_timing = timed_pipe(version, input)
+    response_cache.put(key, algo_response.result)
+    return algo_response, algo_timing
+
+def timed_pipe(version, input):
+    '''
+    Call a version of the target algorithm, returns (algo_response, algo_timing)
+    '''
+    algo_start = time.time()
+    algo_response = client.algo("{}/{}".format(current_state().name, str(version))).pipe(input)
+    algo_timing = time.time() - algo_start
+    metrics.observe("downstream_call", algo_timing)
+    return algo_response, algo_timing
+
+def call_experiment(input, db_stable_version, db_exp_version):
+    '''
+    Call the experiment version and, once it finishes, record its timing and outcome.
+    With hedge_requests, the stable version is called as well when the experiment version
+    fails or hasn't answered within the hedge budget, and the first response is returned.
+    The experiment timing is recorded even when the stable version answered first.
+    Cached experiment responses are returned right away and aren't recorded.
+    '''
+    cache_key = response_cache.key(db_exp_version, input)
+    hit, result = response_cache.get(cache_key)
+    if hit:
+        return CachedResponse(result)
+    budget = get_hedge_budget()
+    experiment_no = get_exp_no()
+    # record() runs on whichever thread finishes the call
+    breaker = current_state().breaker
+
+    def record(future):
+        if future.exception() is not None:
+            breaker.record(True, False)
+            return
+        algo_response, algo_timing = future.result()
+        breaker.record(False, algo_timing > budget)
+        log(2, "Algorithm timing: {}", algo_timing)
+        sample_writer.add(new_sample(experiment_no, db_exp_version, algo_timing))
+        response_cache.put(cache_key, algo_response.result)
+
+    if not hedge_requests:
+        experiment_future = Future()
+        try:
+            experiment_future.set_result(timed_pipe(db_exp_version, input))
+        except Exception as err:
+            experiment_future.set_exception(err)
+        record(experiment_future)
+        return experiment_future.result()[0]
+
+    experiment_future = submit(experiment_executor, timed_pipe, db_exp_version, input)
+    experiment_future.add_done_callback(record)
+    done, _ = wait([experiment_future], timeout=budget)
+    if done and experiment_future.exception() is None:
+        return experiment_future.result()[0]
+    metrics.count("hedged_calls")
+    log(2, "Experiment version {} is slower than {:.3f}s or failed, hedging with the stable version", db_exp_version, budget)
+    pending = {experiment_future, submit(hedge_executor, timed_pipe, db_stable_version, input)}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()[0]
+    raise experiment_future.exception()
+
+shadow_executor = ThreadPoolExecutor(max_workers=shadow_workers, thread_name_prefix="shadow-call")
+shadow_slots = threading.BoundedSemaphore(shadow_workers)
+
+def mirror_request(input, db_stable_version, db_exp_version, stable_timing):
+    '''
+    In shadow mode, call the experiment version with the same input in the background,
+    then record the stable and experiment timings as a pair.
+    Returns False if the request isn't mirrored.
+    '''
+    if random.random() >= shadow_fraction:
+        return False
+    # Don't let mirrored calls pile up behind a slow experiment version
+    if not shadow_slots.acquire(blocking=False):
+        metrics.count("shadow_skipped")
+        log(2, "All shadow workers are busy, not mirroring request")
+        return False
+
+    def call_shadow():
+        breaker = current_state().breaker
+        try:
+            try:
+                _, experiment_timing = timed_pipe(db_exp_version, input)
+            except Exception:
+                # Failed mirrored calls count toward the breaker's error rate, like failed live calls
+                breaker.record(True, False)
+                raise
+            breaker.record(False, False)
+            experiment_no = get_exp_no()
+            sample_writer.add_many([new_sample(experiment_no, db_stable_version, stable_timing),
+                                    new_sample(experiment_no, db_exp_version, experiment_timing)])
+            check_experiment()
+        except Exception as err:
+            log(0, "Mirrored call to version {} failed: {}", db_exp_version, err)
+        finally:
+            shadow_slots.release()
+
+    metrics.count("shadow_mirrored")
+    submit(shadow_executor, call_shadow)
+    return True
+
+def call_algorithm(input):
+    with metrics.timer("routing"):
+        db_stable_version, db_exp_version = get_routing()
+    if db_exp_version is None:
+        metrics.count("requests_stable")
+        log(2, "Calling the stable version: {}", db_stable_version)
+        algo_response, _ = cached_pipe(db_stable_version, input)
+        return algo_response
+    elif experiment_mode == "shadow":
+        # Always serve the stable version, the experiment version only sees a mirrored copy
+        metrics.count("requests_shadow")
+        log(2, "Calling the stable version: {}, mirroring to version: {}", db_stable_version, db_exp_version)
+        algo_response, algo_timing = cached_pipe(db_stable_version, input)
+        if algo_timing is not None:
+            mirror_request(input, db_stable_version, db_exp_version, algo_timing)
+        return algo_response
+    else:
+        metrics.count("requests_split")
         # Get test version
         test_type, test_version = get_test_version()
-        algo_start = time.time()
+        breaker = current_state().breaker
+        if test_type == "experiment" and not breaker.allow():
+            metrics.count("breaker_rejections")
+            log(2, "Circuit breaker is open, calling the stable version instead")
+            # Not a stable sample, it doesn't count toward experiment_count
+            test_type, test_version = "rerouted", db_stable_version
+        elif test_type == "stable" and breaker.is_open():
+            # The experiment arm gets no samples while the breaker is open, so the stable arm doesn't either
+            test_type = "rerouted"
         # Make a call to the testing (either stable or experiment) endpoint
-        print("Calling type: {}, version: {}".format(test_type, test_version))
-        algo_response = client.algo("{}/{}".format(algo_name, str(test_version))).pipe(input)
-        algo_end = time.time()
-        # Calculate total timing for algorithm call
-        algo_timing = algo_end-algo_start
-        algo_exp_data = {"algo_timing": algo_timing}
-        print("Algorithm timing: {}".format(algo_timing))
-        # Register test data into DB
-        register_test_data(algo_exp_data, test_version)
-        # Get total number of experimental calls that have been made
-        experiment_no = get_exp_no()
-        db_exp_count = get_db_exp_data_count(experiment_no)
-        print("Number of test (stable + experiment) calls made: {}".format(db_exp_count))
+        log(2, "Calling type: {}, version: {}", test_type, test_version)
+        if test_type == "experiment":
+            # Experiment timings are registered by call_experiment() once the call finishes
+            algo_response = call_experiment(input, db_stable_version, test_version)
+        elif test_type == "rerouted":
+            algo_response, _ = cached_pipe(test_version, input)
+        else:
+            # Calculate total timing for algorithm call
+            algo_response, algo_timing = cached_pipe(test_version, input)
+            if algo_timing is not None:
+                algo_exp_data = {"algo_timing": algo_timing}
+                log(2, "Algorithm timing: {}", algo_timing)
+                # Register test data into DB
+                register_test_data(algo_exp_data, test_version)
         # After call is made, check if the experiment can be ended
-        if db_exp_count >= experiment_count:
-            print("Resolving experiment")
-            resolve_experiment(experiment_no)
+        check_experiment()
         # At last, return the algorithm response
         return algo_response
 
+batch_executor = ThreadPoolExecutor(max_workers=batch_workers, thread_name_prefix="batch-call")
+
+def pick_batch_version(db_stable_version, db_exp_version):
+    '''
+    Pick the version of one batch item in split mode, None for an item the open circuit breaker
+    sends to the stable version without recording its timing
+    '''
+    if pick_test_type() == "stable":
+        return None if current_state().breaker.is_open() else db_stable_version
+    if current_state().breaker.allow():
+        return db_exp_version
+    metrics.count("breaker_rejections")
+    return None
+
+def call_algorithm_batch(inputs):
+    '''
+    Call the target algorithm for a list of inputs. Routing is resolved once for the whole batch,
+    every item is assigned to the stable or experiment version (or mirrored, in shadow mode), and the calls run concurrently
+    on batch_executor. Returns {"result": ...} or {"error": ...} per input, in input order.
+    '''
+    with metrics.timer("routing"):
+        db_stable_version, db_exp_version = get_routing()
+    metrics.count("batch_items", len(inputs))
+    if db_exp_version is None or experiment_mode == "shadow":
+        test_versions = [db_stable_version] * len(inputs)
+    else:
+        test_versions = [pick_batch_version(db_stable_version, db_exp_version) for _ in inputs]
+
+    def call(item):
+        input, test_version = item
+        try:
+            if test_version == db_exp_version:
+                # Experiment timings are registered by call_experiment() itself
+                return {"result": call_experiment(input, db_stable_version, db_exp_version).result}, None
+            algo_response, algo_timing = cached_pipe(db_stable_version, input)
+        except Exception as err:
+            return {"error": str(err)}, None
+        return {"result": algo_response.result}, algo_timing
+
+    futures = [submit(batch_executor, call, item) for item in zip(inputs, test_versions)]
+    responses = [future.result() for future in futures]
+    if db_exp_version is not None and experiment_mode == "shadow":
+        for input, (_, algo_timing) in zip(inputs, responses):
+            if algo_timing is not None:
+                mirror_request(input, db_stable_version, db_exp_version, algo_timing)
+    elif db_exp_version is not None:
+        # Register all stable test data at once
+        experiment_no = get_exp_no()
+        sample_writer.add_many([new_sample(experiment_no, test_version, algo_timing)
+                                for (_, algo_timing), test_version in zip(responses, test_versions)
+                                if algo_timing is not None and test_version is not None])
+        check_experiment()
+    return [response for response, _ in responses]
+
 def apply(input):
-    # Check if DB has been initialized for this algorithm slot
-    if not check_db_init:
-        init_database()
-    r = call_algorithm(input)
-    return r.result
+    # {"algorithm": name, "input": ...} calls another monitored algorithm than algo_name
+    algorithm, input = parse_target(input)
+    with targeting(algorithm) as state:
+        # Check if DB has been initialized for this algorithm
+        if not state.db_init:
+            init_algorithm()
+        if metrics_log_interval:
+            metrics.start_reporter(metrics_log_interval)
+        # {"batch": [input, ...]} calls the target algorithm once per input
+        if isinstance(input, dict) and list(input) == ["batch"] and isinstance(input["batch"], list):
+            with metrics.timer("batch_request"):
+                return call_algorithm_batch(input["batch"])
+        with metrics.timer("request"):
+            r = call_algorithm(input)
+        return r.result
@@ -0,0 +1,36 @@
+import argparse
+import time
+import model_monitoring as mm
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Resolve model monitoring experiments outside of the orchestrator processes")
+    parser.add_argument("-i", "--interval", type=float, default=5,
+                        help="Seconds between checks whether the running experiment can be resolved")
+    parser.add_argument("-o", "--once", action="store_true",
+                        help="Check once and exit, e.g. when run from cron")
+    args = parser.parse_args()
+    return args
+
+def main(args=None):
+    if isinstance(args, type(None)):
+        args = parse_arguments()
+    run(args)
+
+def run(args):
+    '''
+    Check the running experiment of every algorithm every interval seconds and resolve it once
+    it can be ended. Set resolve_on_requests = False in the orchestrator so it only records samples.
+    Several workers can run at once, the resolve lease makes sure only one of them resolves an experiment.
+    '''
+    mm.init_database()
+    while True:
+        for algorithm in mm.store.get_algorithms():
+            with mm.targeting(algorithm):
+                if mm.experiment_resolver.check():
+                    print("Experiment of {} resolved".format(algorithm))
+        if args.once:
+            return
+        time.sleep(args.interval)
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 import Algorithmia
 import argparse
+import os
+import shutil
 from Algorithmia.errors import AlgorithmException
 
 def parse_arguments():
@@ -135,12 +137,17 @@ def deploy(args):
     algo_script_path = "{}/{}/src/{}.py".format(local_dir, args.algoname, args.algoname)
     dependency_file_path = "{}/{}/{}".format(local_dir, args.algoname, "requirements.txt")
 
+    # The micro-batching helper the script imports lives next to it
+    batching_script = os.path.join(os.path.dirname(args.model_script), "micro_batching.py")
+    batching_script_path = "{}/{}/src/micro_batching.py".format(local_dir, args.algoname)
+
     shutil.copyfile(args.model_script, algo_script_path)
+    shutil.copyfile(batching_script, batching_script_path)
     shutil.copyfile(args.model_dependency_file, dependency_file_path)
 
     ### 8. Upload our source code ###
 
-    files = ["src/{}.py".format(args.algoname), "requirements.txt"]
+    files = ["src/{}.py".format(args.algoname), "src/micro_batching.py", "requirements.txt"]
     cloned_repo.index.add(files)
 
     cloned_repo.index.commit("Add algorithm files")
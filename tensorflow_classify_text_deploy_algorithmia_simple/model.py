@@ -1,7 +1,9 @@
 import Algorithmia
+import tensorflow as tf
 from tensorflow import keras
 import numpy as np
 import pickle
+from micro_batching import MicroBatcher
 
 # Create our Algorithmia client
 client = Algorithmia.client()
@@ -19,25 +21,55 @@ word_index_file = client.file(data_word_index).getFile().name
 with open(word_index_file, "rb") as fh:
     word_index = pickle.load(fh)
 
+# Predictions run on the batcher's thread, which needs the graph the model was loaded into
+graph = tf.get_default_graph()
+
+def predict(input_vectors):
+    with graph.as_default():
+        return model.predict(input_vectors, batch_size=len(input_vectors))
+
+# Concurrent requests are predicted together, up to max_batch_size texts or max_batch_wait seconds
+max_batch_size = 64
+max_batch_wait = 0.005
+batcher = MicroBatcher(predict, max_batch_size, max_batch_wait)
+
+# Precomputed for the tokenizer
+max_length = 256
+pad_value = word_index["<PAD>"]
+lookup_word = word_index.get
+positions = np.arange(max_length)
+
+# Function for vectorizing a batch of input texts into a padded (texts, max_length) int32 matrix
+def vectorize_texts(texts):
+    ids = []
+    lengths = np.empty(len(texts), dtype=np.int64)
+    for row, text in enumerate(texts):
+        # Unknown words are skipped, longer texts keep their last max_length words
+        vector = [index for index in map(lookup_word, text.split(" ")) if index is not None][-max_length:]
+        ids.extend(vector)
+        lengths[row] = len(vector)
+    matrix = np.full((len(texts), max_length), pad_value, dtype=np.int32)
+    # Fill every row from the left in one go, the rest stays padding
+    matrix[positions < lengths[:, np.newaxis]] = ids
+    return matrix
+
 # Function for vectorizing our input text
 def vectorize_text(text):
-    vector = []
-    words = text.split(" ")
-    for word in words:
-        if word in word_index:
-            vector.append(word_index[word])
-
-    return keras.preprocessing.sequence.pad_sequences([np.array(vector, dtype=np.int32)],
-                                               value=word_index["<PAD>"],
-                                               padding='post',
-                                               maxlen=256)
+    return vectorize_texts([text])
 
 def apply(input):
+    # A list of texts (or of {"text": ...}) is scored with a single predict call
+    if isinstance(input, list):
+        texts = [item["text"] if isinstance(item, dict) else item for item in input]
+        if not texts:
+            return []
+        probs = batcher.predict(vectorize_texts(texts))
+        return [{"prob": float(prob[0])} for prob in probs]
     # Get input text
     input_text = input["text"]
     # Vectorize input text
     input_vector = vectorize_text(input_text)
-    # Get probability using our model
-    prob = float(model.predict(input_vector)[0][0])
+    # Get probability using our model, batched with concurrent requests
+    prob = float(batcher.predict(input_vector)[0][0])
     # Return result back to user
-    return {"prob": prob}
\ No newline at end of file
+    return {"prob": prob}